@@ -1,9 +1,11 @@
 # Goal of this file is to run a basic Feathr script within spark so that Maven packages can be downloaded into the docker container to save time during actual run.
 # This can also serve as a sanity check
 
+import itertools
 import os
 import tempfile
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from feathr import FeathrClient
 from feathr import BOOLEAN, FLOAT, INT32, ValueType
@@ -12,7 +14,6 @@ from feathr import FeatureQuery, ObservationSettings
 from feathr import INPUT_CONTEXT, HdfsSource
 from feathr import WindowAggTransformation
 from feathr import TypedKey
-from pyspark.sql import DataFrame
 import feathr
 from pathlib import Path
 
@@ -64,22 +65,33 @@ from feathr.datasets.constants import NYC_TAXI_SMALL_URL
 maybe_download(src_url=NYC_TAXI_SMALL_URL, dst_filepath=DATA_FILE_PATH)
 
 
+# Spark configurations passed to the feature join job.
+# The default of 200 shuffle partitions is far too many for the small NYC taxi sample,
+# and AQE coalesces whatever is left after the window aggregation shuffle.
+spark_execution_configurations = {
+    "spark.sql.shuffle.partitions": os.environ.get("FEATHR_SANDBOX_SHUFFLE_PARTITIONS", "16"),
+    "spark.sql.adaptive.enabled": "true",
+    "spark.sql.adaptive.coalescePartitions.enabled": "true",
+    "spark.sql.adaptive.advisoryPartitionSizeInBytes": os.environ.get("FEATHR_SANDBOX_ADVISORY_PARTITION_SIZE", "64MB"),
+    # Every row is shuffled by the window aggregation, use Kryo and off-heap memory for it
+    "spark.serializer": "org.apache.spark.serializer.KryoSerializer",
+    "spark.memory.offHeap.enabled": "true",
+    "spark.memory.offHeap.size": os.environ.get("FEATHR_SANDBOX_OFF_HEAP_SIZE", "1g"),
+    # Write the result as Parquet instead of the default Avro, so `get_result_df` reads it column-wise
+    "spark.feathr.outputFormat": "parquet",
+}
+
 TIMESTAMP_COL = "lpep_dropoff_datetime"
 TIMESTAMP_FORMAT = "yyyy-MM-dd HH:mm:ss"
-
-
-def preprocessing(df: DataFrame) -> DataFrame:
-    import pyspark.sql.functions as F
-    df = df.withColumn("fare_amount_cents",
-                       (F.col("fare_amount") * 100.0).cast("float"))
-    return df
+# Plain SQL expression instead of a Python preprocessing function, so Spark can
+# fuse it into the aggregation without a round-trip through the Python worker.
+FARE_AMOUNT_CENTS_EXPR = "fare_amount * 100.0"
 
 
 batch_source = HdfsSource(
     name="nycTaxiBatchSource",
     path=DATA_FILE_PATH,
     event_timestamp_column=TIMESTAMP_COL,
-    preprocessing=preprocessing,
     timestamp_format=TIMESTAMP_FORMAT,
 )
 
@@ -120,6 +132,11 @@ features = [
         feature_type=INT32,
         transform="hour(lpep_dropoff_datetime)",
     ),
+    Feature(
+        name="f_fare_amount_cents",
+        feature_type=FLOAT,
+        transform=f"cast_float({FARE_AMOUNT_CENTS_EXPR})",
+    ),
 ]
 
 # After you have defined features, bring them together to build the anchor to the source.
@@ -138,28 +155,20 @@ agg_key = TypedKey(
 
 agg_window = "90d"
 
-# Anchored features with aggregations
+# Anchored features with aggregations.
+# Both features share one key, window and expression spec, only the aggregation function differs.
 agg_features = [
     Feature(
-        name="f_location_avg_fare",
-        key=agg_key,
-        feature_type=FLOAT,
-        transform=WindowAggTransformation(
-            agg_expr="fare_amount_cents",
-            agg_func="AVG",
-            window=agg_window,
-        ),
-    ),
-    Feature(
-        name="f_location_max_fare",
+        name=f"f_location_{agg_func.lower()}_fare",
         key=agg_key,
         feature_type=FLOAT,
         transform=WindowAggTransformation(
-            agg_expr="fare_amount_cents",
-            agg_func="MAX",
+            agg_expr=FARE_AMOUNT_CENTS_EXPR,
+            agg_func=agg_func,
             window=agg_window,
         ),
-    ),
+    )
+    for agg_func in ["AVG", "MAX"]
 ]
 
 agg_feature_anchor = FeatureAnchor(
@@ -189,19 +198,24 @@ client.build_features(
 )
 
 
-feature_names = [feature.name for feature in features + agg_features]
-feature_names
+feature_names = [feature.name for feature in itertools.chain(features, agg_features)]
 
 
-# Try to register the service after the spark run (so that the Feathr API can start with sufficient time)
-try:
-    client.register_features()
-except Exception as e:
-    print(e)
-print(client.list_registered_features(project_name=client.project_name))
+def register_features():
+    try:
+        # Call the registry directly, `client.register_features()` would rewrite the feature config files
+        # the running Spark job reads from.
+        client.registry.register_features(
+            client.local_workspace_dir,
+            anchor_list=client.anchor_list,
+            derived_feature_list=client.derived_feature_list,
+        )
+    except Exception as e:
+        print(e)
+    print(client.list_registered_features(project_name=client.project_name))
 
 
-now = datetime.now().strftime("%Y%m%d%H%M%S")
+now = time.strftime("%Y%m%d%H%M%S")
 offline_features_path = os.path.join("debug", f"test_output_{now}")
 
 # Features that we want to request. Can use a subset of features
@@ -218,9 +232,15 @@ client.get_offline_features(
     observation_settings=settings,
     feature_query=query,
     output_path=offline_features_path,
+    execution_configurations=spark_execution_configurations,
 )
 
-client.wait_job_to_finish(timeout_sec=5000)
+# Registration only talks to the registry, so overlap it with the Spark job instead of running it up front.
+# Doing it while the job runs also gives the Feathr API more time to start.
+with ThreadPoolExecutor(max_workers=1) as executor:
+    registration = executor.submit(register_features)
+    client.wait_job_to_finish(timeout_sec=5000)
+    registration.result()
 
 from feathr.utils.job_utils import get_result_df
 res_df = get_result_df(client)
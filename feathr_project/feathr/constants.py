@@ -6,6 +6,10 @@ REDIS_PASSWORD = "REDIS_PASSWORD"
 # 1MB = 1024*1024
 MB_BYTES = 1048576
 
+# Interval bounds when polling remote Spark job status, in seconds
+JOB_STATUS_POLL_MIN_INTERVAL_SEC = 5
+JOB_STATUS_POLL_MAX_INTERVAL_SEC = 30
+
 INPUT_CONTEXT = "PASSTHROUGH"
 RELATION_CONTAINS = "CONTAINS"
 RELATION_BELONGSTO = "BELONGSTO"
@@ -270,6 +270,7 @@ class _FeathrDatabricksJobLauncher(SparkJobLauncher):
     def wait_for_completion(self, timeout_seconds: Optional[int] = 600) -> bool:
         """Returns true if the job completed successfully"""
         start_time = time.time()
+        poll_interval_sec = JOB_STATUS_POLL_MIN_INTERVAL_SEC
         while (timeout_seconds is None) or (time.time() - start_time < timeout_seconds):
             status = self.get_status()
             logger.debug("Current Spark job status: {}", status)
@@ -289,7 +290,9 @@ class _FeathrDatabricksJobLauncher(SparkJobLauncher):
                     logger.error("{}", result["error_trace"])
                 return False
             else:
-                time.sleep(30)
+                time.sleep(poll_interval_sec)
+                # Back off exponentially, short jobs are noticed early and long ones are not polled more than needed
+                poll_interval_sec = min(poll_interval_sec * 1.5, JOB_STATUS_POLL_MAX_INTERVAL_SEC)
         else:
             raise TimeoutError("Timeout waiting for Feathr job to complete")
 
@@ -224,6 +224,7 @@ class _FeathrSynapseJobLauncher(SparkJobLauncher):
         Returns true if the job completed successfully
         """
         start_time = time.time()
+        poll_interval_sec = JOB_STATUS_POLL_MIN_INTERVAL_SEC
         while (timeout_seconds is None) or (time.time() - start_time < timeout_seconds):
             status = self.get_status()
             logger.info("Current Spark job status: {}", status)
@@ -239,7 +240,9 @@ class _FeathrSynapseJobLauncher(SparkJobLauncher):
                 )
                 return False
             else:
-                time.sleep(30)
+                time.sleep(poll_interval_sec)
+                # Back off exponentially, short jobs are noticed early and long ones are not polled more than needed
+                poll_interval_sec = min(poll_interval_sec * 1.5, JOB_STATUS_POLL_MAX_INTERVAL_SEC)
         else:
             raise TimeoutError("Timeout waiting for job to complete")
 
@@ -1,121 +1,118 @@
-import json
 from typing import Optional
-import requests
+import httpx
+import orjson
 from fastapi import APIRouter, Depends, Response
+from starlette.concurrency import run_in_threadpool
 from rbac import config
 from rbac.access import *
-from rbac.db_rbac import DbRBAC
+from rbac.access import rbac
 from rbac.models import User
 
 router = APIRouter()
-rbac = DbRBAC()
 registry_url = config.RBAC_REGISTRY_URL
 
+# Shared async client, keep-alive connections to the registry are reused across requests
+# and upstream calls don't hold a worker thread while waiting
+session: httpx.AsyncClient = None
+
+
+@router.on_event("startup")
+async def open_session():
+    global session
+    session = httpx.AsyncClient(limits=httpx.Limits(max_connections=200),
+                                transport=httpx.AsyncHTTPTransport(retries=2),
+                                timeout=httpx.Timeout(10, connect=3))
+
+
+@router.on_event("shutdown")
+async def close_session():
+    await session.aclose()
+
 
 @router.get('/projects', name="Get a list of Project Names [No Auth Required]")
-async def get_projects(response: Response) -> list[str]:
-    response.status_code, res = check(
-        requests.get(url=f"{registry_url}/projects"))
-    return res
+async def get_projects() -> Response:
+    return _passthrough(await _request("GET", "/projects"))
 
 
 @router.get('/projects/{project}', name="Get My Project [Read Access Required]")
-async def get_project(project: str, response: Response, access: UserAccess = Depends(project_read_access)):
-    response.status_code, res = check(requests.get(url=f"{registry_url}/projects/{project}",
-                                                   headers=get_api_header(access.user_name)))
-    return res
+async def get_project(project: str, access: UserAccess = Depends(project_read_access)) -> Response:
+    return _passthrough(await _request("GET", f"/projects/{project}", access.user_name))
 
 
 @router.get("/dependent/{entity}", name="Get downstream/dependent entitites for a given entity [Read Access Required]")
-def get_dependent_entities(entity: str, access: UserAccess = Depends(project_read_access)):
-    response = requests.get(url=f"{registry_url}/dependent/{entity}",
-                            headers=get_api_header(access.user_name)).content.decode('utf-8')
-    return json.loads(response)
+async def get_dependent_entities(entity: str, access: UserAccess = Depends(project_read_access)) -> Response:
+    return _passthrough(await _request("GET", f"/dependent/{entity}", access.user_name))
 
 
 @router.get("/projects/{project}/datasources", name="Get data sources of my project [Read Access Required]")
-def get_project_datasources(project: str, response: Response, access: UserAccess = Depends(project_read_access)) -> list:
-    response.status_code, res = check(requests.get(url=f"{registry_url}/projects/{project}/datasources",
-                                                   headers=get_api_header(access.user_name)))
-    return res
+async def get_project_datasources(project: str, access: UserAccess = Depends(project_read_access)) -> Response:
+    return _passthrough(await _request("GET", f"/projects/{project}/datasources", access.user_name))
 
 
 @router.get("/projects/{project}/datasources/{datasource}", name="Get a single data source by datasource Id [Read Access Required]")
-def get_project_datasource(project: str, datasource: str, response: Response, requestor: UserAccess = Depends(project_read_access)) -> list:
-    response.status_code, res = check(requests.get(url=f"{registry_url}/projects/{project}/datasources/{datasource}",
-                                                   headers=get_api_header(requestor.user_name)))
-    return res
+async def get_project_datasource(project: str, datasource: str, requestor: UserAccess = Depends(project_read_access)) -> Response:
+    return _passthrough(await _request("GET", f"/projects/{project}/datasources/{datasource}", requestor.user_name))
 
 
 @router.get("/projects/{project}/features", name="Get features under my project [Read Access Required]")
-def get_project_features(project: str, response: Response, keyword: Optional[str] = None, access: UserAccess = Depends(project_read_access)) -> list:
-    response.status_code, res = check(requests.get(url=f"{registry_url}/projects/{project}/features",
-                                                   headers=get_api_header(access.user_name)))
-    return res
+async def get_project_features(project: str, keyword: Optional[str] = None, access: UserAccess = Depends(project_read_access)) -> Response:
+    return _passthrough(await _request("GET", f"/projects/{project}/features", access.user_name))
 
 
 @router.get("/features/{feature}", name="Get a single feature by feature Id [Read Access Required]")
-def get_feature(feature: str, response: Response, requestor: User = Depends(get_user)) -> dict:
-    response.status_code, res = check(requests.get(url=f"{registry_url}/features/{feature}",
-                                                   headers=get_api_header(requestor.username)))
+async def get_feature(feature: str, response: Response, requestor: User = Depends(get_user)) -> dict:
+    response.status_code, res = await _proxy("GET", f"/features/{feature}", requestor.username)
 
     feature_qualifiedName = res['attributes']['qualifiedName']
-    validate_project_access_for_feature(
-        feature_qualifiedName, requestor, AccessType.READ)
+    await run_in_threadpool(validate_project_access_for_feature,
+                            feature_qualifiedName, requestor, AccessType.READ)
     return res
 
 
 @router.delete("/entity/{entity}", name="Deletes a single entity by qualified name [Write Access Required]")
-def delete_entity(entity: str, response: Response, access: UserAccess = Depends(project_write_access)) -> str:
-    response.status_code, res = check(requests.delete(
-        url=f"{registry_url}/entity/{entity}", headers=get_api_header(access.user_name)))
+async def delete_entity(entity: str, response: Response, access: UserAccess = Depends(project_write_access)) -> str:
+    response.status_code, res = await _proxy("DELETE", f"/entity/{entity}", access.user_name)
     return res
 
 
 @router.get("/features/{feature}/lineage", name="Get Feature Lineage [Read Access Required]")
-def get_feature_lineage(feature: str, response: Response, requestor: User = Depends(get_user)) -> dict:
-    response.status_code, res = check(requests.get(url=f"{registry_url}/features/{feature}/lineage",
-                                                   headers=get_api_header(requestor.username)))
+async def get_feature_lineage(feature: str, response: Response, requestor: User = Depends(get_user)) -> dict:
+    response.status_code, res = await _proxy("GET", f"/features/{feature}/lineage", requestor.username)
 
     feature_qualifiedName = res['guidEntityMap'][feature]['attributes']['qualifiedName']
-    validate_project_access_for_feature(
-        feature_qualifiedName, requestor, AccessType.READ)
+    await run_in_threadpool(validate_project_access_for_feature,
+                            feature_qualifiedName, requestor, AccessType.READ)
     return res
 
 
 @router.post("/projects", name="Create new project with definition [Auth Required]")
-def new_project(definition: dict, response: Response, requestor: User = Depends(get_user)) -> dict:
-    rbac.init_userrole(requestor.username, definition["name"])
-    response.status_code, res = check(requests.post(url=f"{registry_url}/projects", json=definition,
-                                                    headers=get_api_header(requestor.username)))
+async def new_project(definition: dict, response: Response, requestor: User = Depends(get_user)) -> dict:
+    await run_in_threadpool(rbac.init_userrole, requestor.username, definition["name"])
+    response.status_code, res = await _proxy("POST", "/projects", requestor.username, json=definition)
     return res
 
 
 @router.post("/projects/{project}/datasources", name="Create new data source of my project [Write Access Required]")
-def new_project_datasource(project: str, definition: dict, response: Response, access: UserAccess = Depends(project_write_access)) -> dict:
-    response.status_code, res = check(requests.post(url=f"{registry_url}/projects/{project}/datasources", json=definition, headers=get_api_header(
-        access.user_name)))
+async def new_project_datasource(project: str, definition: dict, response: Response, access: UserAccess = Depends(project_write_access)) -> dict:
+    response.status_code, res = await _proxy("POST", f"/projects/{project}/datasources", access.user_name, json=definition)
     return res
 
 
 @router.post("/projects/{project}/anchors", name="Create new anchors of my project [Write Access Required]")
-def new_project_anchor(project: str, definition: dict, response: Response, access: UserAccess = Depends(project_write_access)) -> dict:
-    response.status_code, res = check(requests.post(url=f"{registry_url}/projects/{project}/anchors", json=definition, headers=get_api_header(
-        access.user_name)))
+async def new_project_anchor(project: str, definition: dict, response: Response, access: UserAccess = Depends(project_write_access)) -> dict:
+    response.status_code, res = await _proxy("POST", f"/projects/{project}/anchors", access.user_name, json=definition)
     return res
 
 
 @router.post("/projects/{project}/anchors/{anchor}/features", name="Create new anchor features of my project [Write Access Required]")
-def new_project_anchor_feature(project: str, anchor: str, definition: dict, response: Response, access: UserAccess = Depends(project_write_access)) -> dict:
-    response.status_code, res = check(requests.post(url=f"{registry_url}/projects/{project}/anchors/{anchor}/features", json=definition, headers=get_api_header(
-        access.user_name)))
+async def new_project_anchor_feature(project: str, anchor: str, definition: dict, response: Response, access: UserAccess = Depends(project_write_access)) -> dict:
+    response.status_code, res = await _proxy("POST", f"/projects/{project}/anchors/{anchor}/features", access.user_name, json=definition)
     return res
 
 
 @router.post("/projects/{project}/derivedfeatures", name="Create new derived features of my project [Write Access Required]")
-def new_project_derived_feature(project: str, definition: dict, response: Response, access: UserAccess = Depends(project_write_access)) -> dict:
-    response.status_code, res = check(requests.post(url=f"{registry_url}/projects/{project}/derivedfeatures",
-                                                    json=definition, headers=get_api_header(access.user_name)))
+async def new_project_derived_feature(project: str, definition: dict, response: Response, access: UserAccess = Depends(project_write_access)) -> dict:
+    response.status_code, res = await _proxy("POST", f"/projects/{project}/derivedfeatures", access.user_name, json=definition)
     return res
 
 # Below are access control management APIs
@@ -136,5 +133,21 @@ def delete_userrole(user: str, role: str, reason: str, access: UserAccess = Depe
     return rbac.delete_userrole(access.project_name, user, role, reason, access.user_name)
 
 
+async def _request(method: str, path: str, user_name: Optional[str] = None, **kwargs) -> httpx.Response:
+    """Send a request to the registry on behalf of `user_name`"""
+    headers = get_api_header(user_name) if user_name else None
+    return await session.request(method, f"{registry_url}{path}", headers=headers, **kwargs)
+
+
+async def _proxy(method: str, path: str, user_name: Optional[str] = None, **kwargs):
+    """Send a request to the registry and return its status code and decoded body"""
+    return check(await _request(method, path, user_name, **kwargs))
+
+
+def _passthrough(upstream: httpx.Response) -> Response:
+    """Pass the registry response through as is, no need to decode and re-encode the JSON body"""
+    return Response(content=upstream.content, status_code=upstream.status_code, media_type="application/json")
+
+
 def check(r):
-    return r.status_code, json.loads(r.content.decode("utf-8"))
+    return r.status_code, orjson.loads(r.content)
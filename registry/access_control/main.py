@@ -1,7 +1,10 @@
+import asyncio
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from starlette.middleware.cors import CORSMiddleware
 from rbac import config
+from rbac.auth import authorize
 from api import router as api_router
 
 rp = "/"
@@ -13,7 +16,7 @@ except:
     pass
 
 def get_application() -> FastAPI:
-    application = FastAPI()
+    application = FastAPI(default_response_class=ORJSONResponse)
     # Enables CORS
     application.add_middleware(CORSMiddleware,
                                allow_origins=["*"],
@@ -23,6 +26,16 @@ def get_application() -> FastAPI:
                                )
 
     application.include_router(prefix=rp, router=api_router)
+
+    # Pre-warm and periodically refresh the AAD signing keys used to verify tokens
+    @application.on_event("startup")
+    async def start_refresh_aad_keys():
+        application.state.refresh_aad_keys = asyncio.create_task(authorize.refresh_keys_periodically())
+
+    @application.on_event("shutdown")
+    async def stop_refresh_aad_keys():
+        application.state.refresh_aad_keys.cancel()
+
     return application
 
 
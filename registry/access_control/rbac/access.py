@@ -1,3 +1,4 @@
+from functools import lru_cache
 from time import sleep
 from typing import Any, Union
 from uuid import UUID
@@ -62,14 +63,18 @@ def global_admin_access(user: User = Depends(authorize)):
         raise ForbiddenAccess('Admin privileges required')
 
 def validate_project_access_for_feature(feature:str, user:User, access:str):
+    # Access checks are cached by `DbRBAC`, which drops them on every role change
     project = _get_project_from_feature(feature)
     _project_access(project, user, access)
 
+@lru_cache(maxsize=10000)
 def _get_project_from_feature(feature: str):
     feature_delimiter = "__"
     return feature.split(feature_delimiter)[0]
 
+@lru_cache(maxsize=4096)
 def get_api_header(username: str):
+    # Cached per user, callers must not modify the returned dict
     return {
         "x-registry-requestor": username
     }
@@ -1,11 +1,16 @@
-import base64
+import asyncio
+import json
 import logging
+import threading
+import time
 import requests
-import rsa
+from cachetools import TTLCache
 from typing import Any, Mapping, Optional
 from fastapi import HTTPException, Request, status
 from fastapi.security import OAuth2AuthorizationCodeBearer
 import jwt
+from jwt.algorithms import RSAAlgorithm
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from jwt.exceptions import ExpiredSignatureError, PyJWKError
 
 from rbac import config
@@ -13,7 +18,14 @@ from rbac.models import User, UserType
 
 
 log = logging.getLogger()
-BEARER_TOKEN = "BEARER "
+BEARER_TOKEN = "bearer "
+BEARER_TOKEN_LEN = len(BEARER_TOKEN)
+# AAD signing keys rotate rarely, refresh them in the background this often
+AAD_KEYS_REFRESH_SEC = 3600
+# Unknown key ids trigger a refresh, but not more often than this, to avoid miss storms
+AAD_KEYS_MIN_REFRESH_SEC = 60
+# Requests for the AAD metadata and keys give up after this many seconds
+AAD_KEYS_FETCH_TIMEOUT_SEC = 10
 
 
 class InvalidAuthorization(HTTPException):
@@ -23,8 +35,14 @@ class InvalidAuthorization(HTTPException):
 
 
 class AzureADAuth(OAuth2AuthorizationCodeBearer):
-    # cached AAD jwt keys
-    aad_jwt_keys_cache: dict = {}
+    # cached AAD jwt keys, keyed by kid
+    aad_jwt_keys_cache: TTLCache = TTLCache(maxsize=32, ttl=AAD_KEYS_REFRESH_SEC)
+    # Guards the cache itself and is only held briefly, so reads on the event loop never wait on a fetch
+    aad_jwt_keys_lock = threading.Lock()
+    # Held for the whole fetch, so only one refresh runs at a time
+    aad_jwt_keys_refresh_lock = threading.Lock()
+    # Compared with `time.monotonic()`, whose starting point is arbitrary, "never" must be earlier than any reading
+    aad_jwt_keys_fetched_at: float = float("-inf")
 
     def __init__(self, aad_instance: str = config.RBAC_AAD_INSTANCE, aad_tenant: str = config.RBAC_AAD_TENANT_ID):
         self.base_auth_url: str = f"{aad_instance}/{aad_tenant}"
@@ -39,8 +57,12 @@ class AzureADAuth(OAuth2AuthorizationCodeBearer):
     async def __call__(self, request: Request) -> User:
         bearer_token: str = request.headers.get("authorization")
         if bearer_token:
-            token = bearer_token[len(BEARER_TOKEN):]
-            decoded_token = self._decode_token(token)
+            # The auth scheme is case-insensitive, i.e. `Bearer`, `bearer` and `BEARER` are all valid
+            if bearer_token[:BEARER_TOKEN_LEN].lower() != BEARER_TOKEN:
+                raise InvalidAuthorization(
+                    detail='Authorization header is not a bearer token')
+            token = bearer_token[BEARER_TOKEN_LEN:]
+            decoded_token = await self._decode_token(token)
             return self._get_user_from_token(decoded_token)
         else:
             raise InvalidAuthorization(
@@ -82,12 +104,12 @@ class AzureADAuth(OAuth2AuthorizationCodeBearer):
             username = decoded_token.get(common_user_key)
             type = UserType.COMMON_USER
         else:
-            log.debug(f"unknown user type {decoded_token}")
+            # Log claim names only, the claim values should not end up in logs
+            log.debug("unknown user type, token claims: %s", list(decoded_token))
             username = user_id
             type = UserType.UNKNOWN
 
-        log.info(
-            f"username: {username}, name: {name}, token type: {str(type)} ")
+        log.debug("username: %s, name: %s, token type: %s", username, name, type)
         return User(
             id=user_id,
             name=name,
@@ -101,50 +123,60 @@ class AzureADAuth(OAuth2AuthorizationCodeBearer):
         headers = jwt.get_unverified_header(token)
         return headers['kid'] if headers and 'kid' in headers else None
 
-    @staticmethod
-    def _ensure_b64padding(key: str) -> str:
+    def _cache_aad_keys(self, force: bool = False) -> None:
         """
-        The base64 encoded keys are not always correctly padded, so pad with the right number of =
+        Cache all AAD JWT keys - so we don't have to make a web call each auth request
+        Concurrent callers wait for the refresh in progress instead of fetching the keys again.
         """
-        key = key.encode('utf-8')
-        missing_padding = len(key) % 4
-        for _ in range(missing_padding):
-            key = key + b'='
+        with AzureADAuth.aad_jwt_keys_refresh_lock:
+            if not force and time.monotonic() - AzureADAuth.aad_jwt_keys_fetched_at < AAD_KEYS_MIN_REFRESH_SEC:
+                return
+            response = requests.get(
+                f"{self.base_auth_url}/v2.0/.well-known/openid-configuration", timeout=AAD_KEYS_FETCH_TIMEOUT_SEC)
+            aad_metadata = response.json() if response.ok else None
+            jwks_uri = aad_metadata['jwks_uri'] if aad_metadata and 'jwks_uri' in aad_metadata else None
+            if jwks_uri:
+                response = requests.get(jwks_uri, timeout=AAD_KEYS_FETCH_TIMEOUT_SEC)
+                keys = response.json() if response.ok else None
+                if keys and 'keys' in keys:
+                    # Cache the parsed public keys so jwt.decode doesn't have to load them on each request
+                    parsed = {key['kid']: RSAAlgorithm.from_jwk(json.dumps(key)) for key in keys['keys']}
+                    with AzureADAuth.aad_jwt_keys_lock:
+                        AzureADAuth.aad_jwt_keys_cache.update(parsed)
+                    AzureADAuth.aad_jwt_keys_fetched_at = time.monotonic()
+
+    @staticmethod
+    def _get_cached_key(key_id: str) -> Optional[RSAPublicKey]:
+        # `TTLCache` isn't thread-safe and the keys are refreshed on worker threads
+        with AzureADAuth.aad_jwt_keys_lock:
+            return AzureADAuth.aad_jwt_keys_cache.get(key_id)
+
+    async def _get_token_key(self, key_id: str) -> RSAPublicKey:
+        key = self._get_cached_key(key_id)
+        if key is None:
+            # The fetch blocks and may wait on the lock, keep it off the event loop
+            await asyncio.to_thread(self._cache_aad_keys)
+            key = self._get_cached_key(key_id)
+        if key is None:
+            raise InvalidAuthorization(f'Unable to find signing key {key_id}')
         return key
 
-    def _cache_aad_keys(self) -> None:
+    async def refresh_keys_periodically(self) -> None:
         """
-        Cache all AAD JWT keys - so we don't have to make a web call each auth request
+        Keep the AAD key cache warm so that the auth path doesn't have to fetch keys
         """
-        response = requests.get(
-            f"{self.base_auth_url}/v2.0/.well-known/openid-configuration")
-        aad_metadata = response.json() if response.ok else None
-        jwks_uri = aad_metadata['jwks_uri'] if aad_metadata and 'jwks_uri' in aad_metadata else None
-        if jwks_uri:
-            response = requests.get(jwks_uri)
-            keys = response.json() if response.ok else None
-            if keys and 'keys' in keys:
-                for key in keys['keys']:
-                    n = int.from_bytes(base64.urlsafe_b64decode(
-                        self._ensure_b64padding(key['n'])), "big")
-                    e = int.from_bytes(base64.urlsafe_b64decode(
-                        self._ensure_b64padding(key['e'])), "big")
-                    pub_key = rsa.PublicKey(n, e)
-                    # Cache the PEM formatted public key.
-                    AzureADAuth.aad_jwt_keys_cache[key['kid']] = pub_key.save_pkcs1(
-                    )
-
-    def _get_token_key(self, key_id: str) -> str:
-        if key_id not in AzureADAuth.aad_jwt_keys_cache:
-            self._cache_aad_keys()
-        return AzureADAuth.aad_jwt_keys_cache[key_id]
-
-    def _decode_token(self, token: str) -> Mapping:
+        while True:
+            try:
+                await asyncio.to_thread(self._cache_aad_keys, True)
+            except Exception as e:
+                log.warning("Failed to refresh AAD keys: %s", e)
+            await asyncio.sleep(AAD_KEYS_REFRESH_SEC)
+
+    async def _decode_token(self, token: str) -> Mapping:
         key_id = self._get_key_id(token)
         if not key_id:
-            raise InvalidAuthorization(
-                f'The token does not contain kid: {token}')
-        key = self._get_token_key(key_id)
+            raise InvalidAuthorization('The token does not contain kid')
+        key = await self._get_token_key(key_id)
         try:
             decode = jwt.decode(token, key=key, algorithms=[
                                 'RS256'], audience=["https://management.azure.com", config.RBAC_API_AUDIENCE])
@@ -4,6 +4,8 @@ from starlette.config import Config
 env_file = os.path.join("registry", "access_control", ".env")
 config = Config(os.path.abspath(env_file))
 
+# All settings are resolved once at import time and exposed as plain module level constants,
+# so reading them on the request path is a single module attribute lookup.
 def _get_config(key:str, config:Config = config):
     return os.environ.get(key) or config.get(key)
 
@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
 import logging
+import queue
+import random
 import threading
+import time
 import os
 import pymssql
 
@@ -11,6 +14,31 @@ import pymssql
 
 providers = []
 
+# Connection pool settings, `POOL_SIZE` idle connections are kept, up to `POOL_MAX_OVERFLOW` more
+# can be opened under load, callers wait at most `POOL_TIMEOUT_SEC` for a free connection.
+POOL_SIZE = int(os.environ.get("RBAC_CONNECTION_POOL_SIZE", 20))
+POOL_MAX_OVERFLOW = int(os.environ.get("RBAC_CONNECTION_POOL_MAX_OVERFLOW", 10))
+POOL_TIMEOUT_SEC = 30
+
+# Failed statements are retried up to `RETRY_COUNT` times, but only for errors that can go away by themselves:
+# lost connections (OperationalError), deadlock victims (1205) and Azure SQL throttling/failover (40501, 40613, 49918)
+RETRY_COUNT = 3
+RETRY_BASE_DELAY_SEC = 0.1
+TRANSIENT_ERROR_CODES = {1205, 40501, 40613, 49918}
+
+
+def is_transient_error(e: Exception) -> bool:
+    if isinstance(e, pymssql.OperationalError):
+        return True
+    return bool(e.args) and e.args[0] in TRANSIENT_ERROR_CODES
+
+
+def retry_delay(retry: int) -> float:
+    """
+    Exponential backoff with jitter, so clients hitting the same outage don't retry in lockstep
+    """
+    return RETRY_BASE_DELAY_SEC * (2 ** retry) + random.uniform(0, RETRY_BASE_DELAY_SEC)
+
 
 class DbConnection(ABC):
     @abstractmethod
@@ -18,13 +46,6 @@ class DbConnection(ABC):
         pass
 
 
-def quote(id):
-    if isinstance(id, str):
-        return f"'{id}'"
-    else:
-        return ",".join([f"'{i}'" for i in id])
-
-
 def parse_conn_str(s: str) -> dict:
     """
     TODO: Not a sound and safe implementation, but useful enough in this case
@@ -57,53 +78,89 @@ class MssqlConnection(DbConnection):
 
     def __init__(self, params):
         self.params = params
-        self.make_connection()
-        self.mutex = threading.Lock()
+        # Idle connections, every `query`/`update` borrows one so concurrent requests
+        # don't serialize on a single connection and don't pay a new handshake each time
+        self.pool = queue.LifoQueue(maxsize=POOL_SIZE)
+        self.slots = threading.BoundedSemaphore(POOL_SIZE + POOL_MAX_OVERFLOW)
+        self.pool.put(self.make_connection())
 
     def make_connection(self):
-        self.conn = pymssql.connect(**self.params)
+        return pymssql.connect(**self.params)
 
-    def query(self, sql: str, *args, **kwargs) -> list[dict]:
+    @contextmanager
+    def connection(self):
         """
-        Make SQL query and return result
+        Borrow a connection from the pool, it's returned to the pool when the block exits.
+        Connections raising `pymssql.OperationalError` are considered broken and discarded.
         """
-        logging.debug(f"SQL: `{sql}`")
-        # NOTE: Only one cursor is allowed at the same time
-        retry = 0
-        while True:
+        if not self.slots.acquire(timeout=POOL_TIMEOUT_SEC):
+            raise TimeoutError("Timed out waiting for a database connection")
+        conn = None
+        try:
             try:
-                with self.mutex:
-                    c = self.conn.cursor(as_dict=True)
-                    c.execute(sql, *args, **kwargs)
-                    return c.fetchall()
-            except pymssql.OperationalError:
-                logging.warning("Database error, retrying...")
-                # Reconnect
-                self.make_connection()
-                retry += 1
-                if retry >= 3:
-                    # Stop retrying
-                    raise
-                pass
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                conn = self.make_connection()
+            yield conn
+        except pymssql.OperationalError:
+            self._close(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                try:
+                    self.pool.put_nowait(conn)
+                except queue.Full:
+                    self._close(conn)
+            self.slots.release()
 
-    def update(self, sql: str, *args, **kwargs):
+    @staticmethod
+    def _close(conn):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _run_with_retry(self, fn):
+        """
+        Run `fn` with a borrowed connection, retrying transient database errors
+        """
         retry = 0
         while True:
             try:
-                with self.mutex:
-                    c = self.conn.cursor(as_dict=True)
-                    c.execute(sql, *args, **kwargs)
-                    self.conn.commit()
-                    return True
-            except pymssql.OperationalError:
-                logging.warning("Database error, retrying...")
-                # Reconnect
-                self.make_connection()
+                with self.connection() as conn:
+                    return fn(conn)
+            except pymssql.DatabaseError as e:
                 retry += 1
-                if retry >= 3:
+                if retry >= RETRY_COUNT or not is_transient_error(e):
                     # Stop retrying
                     raise
-                pass
+                logging.warning("Database error, retrying...")
+                # A broken connection has been discarded, next attempt uses another one
+                time.sleep(retry_delay(retry))
+
+    def query(self, sql: str, *args, **kwargs) -> list[dict]:
+        """
+        Make SQL query and return result
+        """
+        logging.debug("SQL: `%s`", sql)
+
+        def run(conn):
+            c = conn.cursor(as_dict=True)
+            c.execute(sql, *args, **kwargs)
+            return c.fetchall()
+        return self._run_with_retry(run)
+
+    def update(self, sql: str, *args, **kwargs):
+        def run(conn):
+            c = conn.cursor(as_dict=True)
+            c.execute(sql, *args, **kwargs)
+            conn.commit()
+            # Number of affected rows
+            return c.rowcount
+        return self._run_with_retry(run)
 
     @contextmanager
     def transaction(self):
@@ -125,21 +182,17 @@ class MssqlConnection(DbConnection):
                 c.close(...)
         ```
         """
-        conn = None
-        cursor = None
-        try:
-            # As one MssqlConnection has only one connection, we need to create a new one to disable `autocommit`
-            conn = MssqlConnection.connect(autocommit=False).conn
+        # Pooled connections keep pymssql's default of `autocommit` off, so a borrowed one
+        # holds the transaction until it is committed or rolled back here
+        with self.connection() as conn:
             cursor = conn.cursor(as_dict=True)
-            yield cursor
-        except Exception as e:
-            logging.warning(f"Exception: {e}")
-            if conn:
+            try:
+                yield cursor
+            except Exception as e:
+                logging.warning(f"Exception: {e}")
                 conn.rollback()
-            raise e
-        finally:
-            if conn:
-                conn.commit()
+                raise e
+            conn.commit()
 
 
 providers.append(MssqlConnection)
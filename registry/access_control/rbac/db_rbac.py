@@ -1,11 +1,57 @@
+from collections import defaultdict
 from fastapi import HTTPException, status
 from typing import Any
+from cachetools import TTLCache
 from rbac import config
 from rbac.database import connect
 from rbac.models import AccessType, UserRole, RoleType, SUPER_ADMIN_SCOPE, _to_uuid
 from rbac.interface import RBAC
 import os
 import logging
+import threading
+import time
+
+# User roles and access checks are cached for a short time, writes made in this process
+# invalidate the cache immediately, writes from other processes show up after the TTL.
+ROLE_CACHE_TTL_SEC = 30
+
+# Bumped on every user role write in this process, every `DbRBAC` instance drops its cached
+# access checks once it sees a new generation, not only the instance the write went through
+_roles_generation = 0
+_roles_generation_lock = threading.Lock()
+
+
+def _bump_roles_generation():
+    global _roles_generation
+    with _roles_generation_lock:
+        _roles_generation += 1
+
+# All statements are built once here and values are passed as query parameters,
+# the SQL text stays the same so the server can reuse its plan.
+# create_time/delete_time are always set by the server with getutcdate(), never sent from the client,
+# so every instance writes timestamps from the same clock in the column's native datetime type.
+SELECT_ACTIVE_USERROLES_SQL = fr"""select record_id, project_name, user_name, role_name, create_by, create_reason, create_time, delete_by, delete_reason, delete_time
+    from userroles
+    where delete_reason is null"""
+SELECT_USERROLES_BY_USER_SQL = SELECT_ACTIVE_USERROLES_SQL + " and user_name = %s"
+SELECT_USERROLES_BY_USER_ROLE_SQL = SELECT_USERROLES_BY_USER_SQL + " and role_name = %s"
+SELECT_USERROLES_BY_PROJECT_SQL = SELECT_ACTIVE_USERROLES_SQL + " and project_name = %s"
+SELECT_USERROLES_BY_PROJECT_ROLE_SQL = SELECT_USERROLES_BY_PROJECT_SQL + " and role_name = %s"
+SELECT_MANAGED_USERROLES_SQL = SELECT_ACTIVE_USERROLES_SQL + fr""" and project_name in (
+    select project_name from userroles where delete_reason is null and user_name = %s and role_name = %s)"""
+DELETE_USERROLE_SQL = fr"""UPDATE userroles SET
+    [delete_by] = %s,
+    [delete_reason] = %s,
+    [delete_time] = getutcdate()
+    WHERE [user_name] = %s and [project_name] = %s and [role_name] = %s
+    and [delete_time] is null"""
+INSERT_USERROLE_SQL = fr"""insert into userroles (project_name, user_name, role_name, create_by, create_reason, create_time)
+    values (%s, %s, %s, %s, %s, getutcdate())"""
+INIT_PROJECT_ADMIN_SQL = fr"""insert into userroles (project_name, user_name, role_name, create_by, create_reason, create_time)
+    select %s, %s, %s, %s, %s, getutcdate()
+    where not exists (select 1 from userroles with (updlock, holdlock) where project_name = %s and delete_reason is null)"""
+PROJECT_ADMIN_CREATE_BY = "system"
+PROJECT_ADMIN_CREATE_REASON = "creator of project, get admin by default."
 
 class BadRequest(HTTPException):
     def __init__(self, detail: Any = None) -> None:
@@ -20,46 +66,85 @@ class DbRBAC(RBAC):
         self.conn = connect()
         self.get_userroles()
         self.projects_ids = {}
+        self._role_cache = TTLCache(maxsize=10_000, ttl=ROLE_CACHE_TTL_SEC)
+        self._role_cache_lock = threading.Lock()
+        self._role_cache_generation = _roles_generation
+
+    def _invalidate_role_cache(self):
+        """
+        Called after every user role write, the roles are reloaded here and in every other instance of this process
+        """
+        _bump_roles_generation()
+        self.get_userroles()
+        with self._role_cache_lock:
+            self._role_cache.clear()
+            self._role_cache_generation = _roles_generation
 
     def get_userroles(self):
-        # Cache is not supported in cluster, make sure every operation read from database.
-        self.userroles = self._get_userroles()
+        """reload all user roles and rebuild the lookup indices
+        """
+        # Read before the query, a write landing while it runs leaves the index marked as stale
+        generation = _roles_generation
+        userroles = self._get_userroles()
+        by_user_project = defaultdict(list)
+        global_admins = set()
+        for u in userroles:
+            by_user_project[(u.user_name, u.project_name)].append(u)
+            if u.project_name == SUPER_ADMIN_SCOPE and u.role_name == RoleType.ADMIN.value:
+                global_admins.add(u.user_name)
+        self.userroles, self._by_user_project, self._global_admins = userroles, by_user_project, global_admins
+        self._userroles_loaded_at = time.monotonic()
+        self._userroles_generation = generation
+
+    def _refresh_userroles_if_stale(self):
+        # Writes through any instance in this process reload the roles right away,
+        # writes from other processes are picked up once the TTL is over
+        if self._userroles_generation != _roles_generation or \
+                time.monotonic() - self._userroles_loaded_at > ROLE_CACHE_TTL_SEC:
+            self.get_userroles()
 
     def _get_userroles(self) -> list[UserRole]:
         """query all the active user role records in SQL table
         """
-        rows = self.conn.query(
-            fr"""select record_id, project_name, user_name, role_name, create_by, create_reason, create_time, delete_by, delete_reason, delete_time
-            from userroles
-            where delete_reason is null""")
+        rows = self.conn.query(SELECT_ACTIVE_USERROLES_SQL)
         ret = []
         for row in rows:
             ret.append(UserRole(**row))
-        logging.info(f"{ret.__len__} user roles are get.")
+        logging.debug("%d user roles are get.", len(ret))
         return ret
 
     def get_global_admin_users(self) -> list[str]:
-        self.get_userroles()
-        return [u.user_name for u in self.userroles if (u.project_name == SUPER_ADMIN_SCOPE and u.role_name == RoleType.ADMIN.value)]
+        self._refresh_userroles_if_stale()
+        return list(self._global_admins)
 
     def validate_project_access_users(self, project: str, user: str, access: str = AccessType.READ) -> bool:
-        self.get_userroles()
-        for u in self.userroles:
-            if (u.user_name == user.lower() and u.project_name in [project.lower(), SUPER_ADMIN_SCOPE] and (access in u.access)):
-                return True
-        return False
+        key = (user.lower(), project.lower(), access)
+        with self._role_cache_lock:
+            if self._role_cache_generation != _roles_generation:
+                # User roles were changed through another instance
+                self._role_cache.clear()
+                self._role_cache_generation = _roles_generation
+            granted = self._role_cache.get(key)
+            generation = self._role_cache_generation
+        if granted is None:
+            self._refresh_userroles_if_stale()
+            user = user.lower()
+            roles = self._by_user_project.get((user, project.lower()), []) + \
+                self._by_user_project.get((user, SUPER_ADMIN_SCOPE), [])
+            granted = any(access in u.access for u in roles)
+            with self._role_cache_lock:
+                # Don't store a result computed from the roles as they were before a write
+                if generation == _roles_generation:
+                    self._role_cache[key] = granted
+        return granted
 
     def get_userroles_by_user(self, user_name: str, role_name: str = None) -> list[UserRole]:
         """query the active user role of certain user
         """
-        query = fr"""select record_id, project_name, user_name, role_name, create_by, create_reason, create_time, delete_by, delete_reason, delete_time
-            from userroles
-            where delete_reason is null and user_name ='%s'"""
         if role_name:
-            query += fr"and role_name = '%s'"
-            rows = self.conn.query(query % (user_name.lower(), role_name.lower()))
+            rows = self.conn.query(SELECT_USERROLES_BY_USER_ROLE_SQL, (user_name.lower(), role_name.lower()))
         else:
-            rows = self.conn.query(query % (user_name.lower()))
+            rows = self.conn.query(SELECT_USERROLES_BY_USER_SQL, (user_name.lower(),))
         ret = []
         for row in rows:
             ret.append(UserRole(**row))
@@ -68,14 +153,10 @@ class DbRBAC(RBAC):
     def get_userroles_by_project(self, project_name: str, role_name: str = None) -> list[UserRole]:
         """query the active user role of certain project.
         """
-        query = fr"""select record_id, project_name, user_name, role_name, create_by, create_reason, create_time, delete_reason, delete_time
-            from userroles
-            where delete_reason is null and project_name ='%s'"""
         if role_name:
-            query += fr"and role_name = '%s'"
-            rows = self.conn.query(query % (project_name.lower(), role_name.lower()))
+            rows = self.conn.query(SELECT_USERROLES_BY_PROJECT_ROLE_SQL, (project_name.lower(), role_name.lower()))
         else:
-            rows = self.conn.query(query % (project_name.lower()))
+            rows = self.conn.query(SELECT_USERROLES_BY_PROJECT_SQL, (project_name.lower(),))
         ret = []
         for row in rows:
             ret.append(UserRole(**row))
@@ -84,50 +165,40 @@ class DbRBAC(RBAC):
     def list_userroles(self, user_name: str) -> list[UserRole]:
         ret = []
         if user_name in self.get_global_admin_users():
-            return list([r.to_dict() for r in self.userroles])
+            return [r.to_dict() for r in self.userroles]
         else:
-            admin_roles = self.get_userroles_by_user(
-                user_name, RoleType.ADMIN.value)
-            ret = []
-            for r in admin_roles:
-                ret.extend(self.get_userroles_by_project(r.project_name))
-        return list([r.to_dict() for r in ret])
+            # All active roles of the projects this user is admin of, in one query
+            rows = self.conn.query(SELECT_MANAGED_USERROLES_SQL, (user_name.lower(), RoleType.ADMIN.value))
+            ret = [UserRole(**row) for row in rows]
+        return [r.to_dict() for r in ret]
 
     def add_userrole(self, project_name: str, user_name: str, role_name: str, create_reason: str, by: str):
         """insert new user role relationship into sql table
         """
         # check if record already exist
         self.get_userroles()
-        for u in self.userroles:
-            if u.project_name == project_name.lower() and u.user_name == user_name.lower() and u.role_name == role_name:
+        for u in self._by_user_project.get((user_name.lower(), project_name.lower()), []):
+            if u.role_name == role_name.lower():
                 logging.warning(
                     f"User {user_name} already have {role_name} role of {project_name}.")
                 return True
 
         # insert new record
-        query = fr"""insert into userroles (project_name, user_name, role_name, create_by, create_reason, create_time)
-            values ('%s','%s','%s','%s' ,'%s', getutcdate())"""
-        self.conn.update(query % (project_name.lower(), user_name.lower(),
-                         role_name.lower(), by, create_reason.replace("'", "''")))
-        logging.info(
-            f"Userrole added with query: {query%(project_name, user_name, role_name, by, create_reason)}")
-        self.get_userroles()
+        self.conn.update(INSERT_USERROLE_SQL, (project_name.lower(), user_name.lower(),
+                         role_name.lower(), by, create_reason))
+        logging.info("Userrole added: %s is %s of %s, by %s",
+                     user_name, role_name, project_name, by)
+        self._invalidate_role_cache()
         return
 
     def delete_userrole(self, project_name: str, user_name: str, role_name: str, delete_reason: str, by: str):
         """mark existing user role relationship as deleted with reason
         """
-        query = fr"""UPDATE userroles SET
-            [delete_by] = '%s',
-            [delete_reason] = '%s',
-            [delete_time] = getutcdate()
-            WHERE [user_name] = '%s' and [project_name] = '%s' and [role_name] = '%s'
-            and [delete_time] is null"""
-        self.conn.update(query % (by, delete_reason.replace("'", "''"),
+        self.conn.update(DELETE_USERROLE_SQL, (by, delete_reason,
                          user_name.lower(), project_name.lower(), role_name.lower()))
-        logging.info(
-            f"Userrole removed with query: {query%(by, delete_reason, user_name, project_name, role_name)}")
-        self.get_userroles()
+        logging.info("Userrole removed: %s is no longer %s of %s, by %s",
+                     user_name, role_name, project_name, by)
+        self._invalidate_role_cache()
         return
 
     def init_userrole(self, creator_name: str, project_name:str):
@@ -137,27 +208,22 @@ class DbRBAC(RBAC):
         if project_name.casefold() == SUPER_ADMIN_SCOPE.casefold():
             raise BadRequest(f"{SUPER_ADMIN_SCOPE} is keyword for Global Admin (admin of all projects), please try other project name.")
         else:
-            # check if project already exist (have valid rbac records)
+            # initialize project admin only if project not exist (have no valid rbac records),
+            # checked and inserted in one statement so concurrent requests can't both succeed
             # no 400 exception to align the registry api behaviors
-            query = fr"""select project_name, user_name, role_name, create_by, create_reason, create_time, delete_reason, delete_time
-                from userroles
-                where delete_reason is null and project_name ='%s'"""
-            rows = self.conn.query(query%(project_name.lower()))
-            if len(rows) > 0:
+            inserted = self.conn.update(INIT_PROJECT_ADMIN_SQL, (project_name.lower(), creator_name.lower(),
+                                        RoleType.ADMIN.value, PROJECT_ADMIN_CREATE_BY, PROJECT_ADMIN_CREATE_REASON,
+                                        project_name.lower()))
+            if not inserted:
                 logging.warning(f"{project_name} already exist, please pick another name.")
                 return
-            else:
-                # initialize project admin if project not exist: 
-                self.init_project_admin(creator_name, project_name)
-          
-            
+            logging.info("Userrole initialized: %s is admin of %s", creator_name, project_name)
+            self._invalidate_role_cache()
+
     def init_project_admin(self, creator_name: str, project_name: str):
         """initialize the creator as project admin when a new project is created
         """
-        create_by = "system"
-        create_reason = "creator of project, get admin by default."
-        query = fr"""insert into userroles (project_name, user_name, role_name, create_by, create_reason, create_time)
-            values ('%s','%s','%s','%s','%s', getutcdate())"""
-        self.conn.update(query % (project_name.lower(), creator_name.lower(), RoleType.ADMIN.value, create_by, create_reason))
-        logging.info(f"Userrole initialized with query: {query%(project_name, creator_name, RoleType.ADMIN.value, create_by, create_reason)}")
-        return self.get_userroles()
\ No newline at end of file
+        self.conn.update(INSERT_USERROLE_SQL, (project_name.lower(), creator_name.lower(),
+                         RoleType.ADMIN.value, PROJECT_ADMIN_CREATE_BY, PROJECT_ADMIN_CREATE_REASON))
+        logging.info("Userrole initialized: %s is admin of %s", creator_name, project_name)
+        self._invalidate_role_cache()
@@ -136,7 +136,7 @@ def _to_type(value, type):
     if isinstance(value, type):
         return value
     if isinstance(value, list):
-        return list([_to_type(v, type) for v in value])
+        return [_to_type(v, type) for v in value]
     if isinstance(value, dict):
         if hasattr(type, "new"):
             try:
@@ -10,4 +10,9 @@ create table userroles
     delete_by varchar(50),
     delete_reason varchar(50),
     delete_time datetime,
-)
\ No newline at end of file
+)
+
+-- Lookups only ever read active records (delete_reason is null), by user and project or by project
+create index ix_userroles_user_project_active on userroles (user_name, project_name) include (role_name) where delete_reason is null
+
+create index ix_userroles_project_active on userroles (project_name) include (user_name, role_name) where delete_reason is null
\ No newline at end of file
@@ -0,0 +1,42 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datetime import datetime
+import unittest, pytest
+
+
+@pytest.mark.skipif(os.getenv("RBAC_CONNECTION_STR") is None, reason="Cannot get environment variable: 'RBAC_CONNECTION_STR'")
+class RoleCacheTest(unittest.TestCase):
+    def setUp(self):
+        # Connects to the database on import
+        from rbac.db_rbac import DbRBAC
+        # Requests are authorized by one instance while role writes may go through another
+        self.reader = DbRBAC()
+        self.writer = DbRBAC()
+        now = datetime.now()
+        self.project = f"unit_test_rbac_project_{now:%H%M%S%f}"
+        self.user = f"unit_test_rbac_user_{now:%H%M%S%f}"
+
+    def test_role_writes_invalidate_all_instances(self):
+        from rbac.models import AccessType, RoleType
+        # Cache a denial first, it must not outlive the write below
+        assert not self.reader.validate_project_access_users(self.project, self.user, AccessType.READ)
+
+        self.writer.init_userrole(self.user, self.project)
+        assert self.reader.validate_project_access_users(self.project, self.user, AccessType.READ)
+        assert self.reader.validate_project_access_users(self.project, self.user, AccessType.MANAGE)
+
+        self.writer.delete_userrole(self.project, self.user, RoleType.ADMIN.value, "unit test cleanup", "unit_test")
+        assert not self.reader.validate_project_access_users(self.project, self.user, AccessType.READ)
+
+    def test_global_admins_follow_writes(self):
+        from rbac.models import RoleType, SUPER_ADMIN_SCOPE
+        assert self.user not in self.reader.get_global_admin_users()
+        self.writer.add_userrole(SUPER_ADMIN_SCOPE, self.user, RoleType.ADMIN.value, "unit test", "unit_test")
+        assert self.user in self.reader.get_global_admin_users()
+        self.writer.delete_userrole(SUPER_ADMIN_SCOPE, self.user, RoleType.ADMIN.value, "unit test cleanup", "unit_test")
+        assert self.user not in self.reader.get_global_admin_users()
+
+
+if __name__ == "__main__":
+    unittest.main()
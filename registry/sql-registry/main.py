@@ -1,13 +1,18 @@
 import os
 import traceback
-from typing import Optional, Dict, List
+import anyio
+import hashlib
+import orjson
+from typing import Callable, Iterator, Optional, Dict, List
 from uuid import UUID
-from fastapi import APIRouter, FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from starlette.middleware.cors import CORSMiddleware
 from registry import *
+from registry.cache import ResponseCache
 from registry.db_registry import DbRegistry, ConflictError
-from registry.models import AnchorDef, AnchorFeatureDef, DerivedFeatureDef, EntityType, ProjectDef, SourceDef, to_snake
+from registry.models import AnchorDef, AnchorFeatureDef, DerivedFeatureDef, Entity, EntityType, ProjectDef, SourceDef, to_snake
 
 rp = "/"
 try:
@@ -18,9 +23,55 @@ except:
     pass
 print("Using API BASE: ", rp)
 
-registry = DbRegistry()
-app = FastAPI()
-router = APIRouter()
+# Read once at import time, "0"/"false" disable it rather than counting as a non-empty string
+REGISTRY_DEBUGGING = os.environ.get("REGISTRY_DEBUGGING", "").lower() in ("1", "true", "yes", "on")
+
+# Created on startup rather than at import time, so importing this module doesn't connect to the database
+registry: Optional[DbRegistry] = None
+# Projects, data sources, lineage and dependencies rarely change, every write below clears the cache
+response_cache = ResponseCache(ttl=int(os.environ.get("REGISTRY_RESPONSE_CACHE_TTL", 10)))
+# orjson serializes the large entity lists considerably faster than the standard json module,
+# GET routes return an `ORJSONResponse` directly so FastAPI doesn't walk the payload with `jsonable_encoder` first
+app = FastAPI(default_response_class=ORJSONResponse)
+
+
+class ORJSONRequest(Request):
+    async def json(self):
+        # `orjson.JSONDecodeError` subclasses `json.JSONDecodeError`, so malformed bodies still get a 422
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+
+class ORJSONRoute(APIRoute):
+    """
+    Parses request bodies with orjson instead of the standard json module
+    """
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            return await handler(ORJSONRequest(request.scope, request.receive))
+        return route_handler
+
+
+router = APIRouter(route_class=ORJSONRoute)
+
+@app.on_event("startup")
+def open_registry():
+    global registry
+    registry = DbRegistry()
+
+@app.on_event("shutdown")
+def close_registry():
+    registry.close()
+
+@app.on_event("startup")
+def set_threadpool_size():
+    # Route handlers are sync and run in the threadpool while they wait on the database,
+    # the default of 40 threads queues requests long before the database is the bottleneck
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = int(os.environ.get("REGISTRY_THREADPOOL_SIZE", 100))
 
 # Enables CORS
 app.add_middleware(CORSMiddleware,
@@ -32,135 +83,162 @@ app.add_middleware(CORSMiddleware,
 
 def exc_to_content(e: Exception) -> Dict:
     content={"message": str(e)}
-    if os.environ.get("REGISTRY_DEBUGGING"):
+    if REGISTRY_DEBUGGING:
         content["traceback"] = "".join(traceback.TracebackException.from_exception(e).format())
     return content
 
-@app.exception_handler(ConflictError)
-async def conflict_error_handler(_, exc: ConflictError):
-    return JSONResponse(
-        status_code=409,
-        content=exc_to_content(exc),
-    )
-
-
-@app.exception_handler(ValueError)
-async def value_error_handler(_, exc: ValueError):
-    return JSONResponse(
-        status_code=400,
-        content=exc_to_content(exc),
-    )
-
-@app.exception_handler(TypeError)
-async def type_error_handler(_, exc: ValueError):
-    return JSONResponse(
-        status_code=400,
-        content=exc_to_content(exc),
-    )
-
-
-@app.exception_handler(KeyError)
-async def key_error_handler(_, exc: KeyError):
-    return JSONResponse(
-        status_code=404,
-        content=exc_to_content(exc),
-    )
-
-@app.exception_handler(IndexError)
-async def index_error_handler(_, exc: IndexError):
-    return JSONResponse(
-        status_code=404,
-        content=exc_to_content(exc),
-    )
+# HTTP status code returned for each exception type raised by the registry
+STATUS_BY_EXC = {
+    ConflictError: 409,
+    ValueError: 400,
+    TypeError: 400,
+    KeyError: 404,
+    IndexError: 404,
+}
+
+def _make_exception_handler(status_code: int):
+    async def handler(_, exc: Exception):
+        return JSONResponse(
+            status_code=status_code,
+            content=exc_to_content(exc),
+        )
+    return handler
+
+for exc_type, status_code in STATUS_BY_EXC.items():
+    app.add_exception_handler(exc_type, _make_exception_handler(status_code))
+
+
+# Streamed listings are sent in chunks of about this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _stream_json_array(entities: Iterator[Entity]) -> Iterator[bytes]:
+    """
+    Encode entities as a JSON array chunk by chunk, so neither the full list of dicts nor the full body is held in memory
+    """
+    chunk = bytearray(b"[")
+    for i, e in enumerate(entities):
+        if i > 0:
+            chunk += b","
+        chunk += orjson.dumps(e.to_dict())
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk.clear()
+    chunk += b"]"
+    yield bytes(chunk)
+
+
+def _etag_response(request: Request, key, fetch: Callable) -> Response:
+    """
+    Serve the JSON body returned by `fetch` with an ETag, or 304 if the client already has it.
+    The encoded body and its ETag are cached together, so a repeated read neither queries nor serializes.
+    """
+    def encode():
+        body = ORJSONResponse(fetch()).body
+        return body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    body, etag = response_cache.get_or_compute(key, encode)
+    headers = {"ETag": etag, "Cache-Control": "private, must-revalidate"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @router.get("/projects")
-def get_projects() -> List[str]:
-    return registry.get_projects()
+def get_projects(request: Request) -> Response:
+    return _etag_response(request, "projects", registry.get_projects)
 
 @router.get("/projects-ids")
-def get_projects_ids() -> Dict:
-    return registry.get_projects_ids()
+def get_projects_ids(request: Request) -> Response:
+    return _etag_response(request, "projects-ids", registry.get_projects_ids)
 
 @router.get("/projects/{project}")
-def get_projects(project: str) -> Dict:
-    return registry.get_project(project).to_dict()
+def get_projects(project: str) -> ORJSONResponse:
+    def fetch():
+        return registry.get_project(project).to_dict()
+    return ORJSONResponse(response_cache.get_or_compute(("project", project), fetch))
 
 @router.get("/dependent/{entity}")
-def get_dependent_entities(entity: str) -> List:
-    entity_id = registry.get_entity_id(entity)
-    downstream_entities = registry.get_dependent_entities(entity_id)
-    return list([e.to_dict() for e in downstream_entities])
+def get_dependent_entities(entity: str) -> ORJSONResponse:
+    def fetch():
+        entity_id = registry.get_entity_id(entity)
+        downstream_entities = registry.get_dependent_entities(entity_id)
+        return [e.to_dict() for e in downstream_entities]
+    return ORJSONResponse(response_cache.get_or_compute(("dependent", entity), fetch))
 
 @router.delete("/entity/{entity}")
 def delete_entity(entity: str):
     entity_id = registry.get_entity_id(entity)
     downstream_entities = registry.get_dependent_entities(entity_id)
     if len(downstream_entities) > 0:
-        registry.delete_empty_entities(downstream_entities)
-        if len(registry.get_dependent_entities(entity_id)) > 0:
+        if registry.delete_empty_entities(downstream_entities):
+            # Empty anchors and sources are gone even if this entity can't be deleted below
+            response_cache.clear()
+            downstream_entities = registry.get_dependent_entities(entity_id)
+        if len(downstream_entities) > 0:
             raise HTTPException(
                 status_code=412, detail=f"""Entity cannot be deleted as it has downstream/dependent entities.
-                Entities: {list([e.qualified_name for e in downstream_entities])}"""
+                Entities: {[e.qualified_name for e in downstream_entities]}"""
             )
     registry.delete_entity(entity_id)
+    response_cache.clear()
 
 @router.get("/projects/{project}/datasources")
-def get_project_datasources(project: str) -> List:
-    p = registry.get_entity(project)
-    source_ids = [s.id for s in p.attributes.sources]
-    sources = registry.get_entities(source_ids)
-    return list([e.to_dict() for e in sources])
+def get_project_datasources(project: str) -> ORJSONResponse:
+    def fetch():
+        sources = registry.get_project_datasources(project)
+        return [e.to_dict() for e in sources]
+    return ORJSONResponse(response_cache.get_or_compute(("datasources", project), fetch))
 
 
 @router.get("/projects/{project}/datasources/{datasource}")
-def get_datasource(project: str, datasource: str) -> Dict:
-    p = registry.get_entity(project)
-    for s in p.attributes.sources:
-        if str(s.id) == datasource:
-            return s.to_dict()
-    # If datasource is not found, raise 404 error
-    raise HTTPException(
-        status_code=404, detail=f"Data Source {datasource} not found")
+def get_datasource(project: str, datasource: str) -> ORJSONResponse:
+    def fetch():
+        s = registry.get_project_datasource(project, datasource)
+        if s is None:
+            # If datasource is not found, raise 404 error
+            raise HTTPException(
+                status_code=404, detail=f"Data Source {datasource} not found")
+        return s.to_dict()
+    return ORJSONResponse(response_cache.get_or_compute(("datasource", project, datasource), fetch))
 
 
 @router.get("/projects/{project}/features")
-def get_project_features(project: str, keyword: Optional[str] = None, page: Optional[int] = None, limit: Optional[int] = None) -> List:
-    if keyword:
-        start =  None
-        size = None
-        if page is not None and limit is not None:
-            start = (page - 1) * limit
-            size = limit
-        efs = registry.search_entity(
-            keyword, [EntityType.AnchorFeature, EntityType.DerivedFeature], project=project, start=start, size=size)
-        feature_ids = [ef.id for ef in efs]
-        features = registry.get_entities(feature_ids)
-        return list([e.to_dict() for e in features])
-    else:
-        p = registry.get_entity(project)
-        feature_ids = [s.id for s in p.attributes.anchor_features] + \
-            [s.id for s in p.attributes.derived_features]
-        features = registry.get_entities(feature_ids)
-        return list([e.to_dict() for e in features])
+def get_project_features(project: str, keyword: Optional[str] = None, page: Optional[int] = None, limit: Optional[int] = None) -> Response:
+    if (page is None) != (limit is None):
+        raise HTTPException(
+            status_code=400, detail="page and limit must be provided together")
+    start =  None
+    size = None
+    if page is not None and limit is not None:
+        start = (page - 1) * limit
+        size = limit
+    features = registry.iter_project_features(project, keyword=keyword, start=start, size=size)
+    return StreamingResponse(_stream_json_array(features), media_type="application/json")
 
 
 @router.get("/features/{feature}")
-def get_feature(feature: str) -> Dict:
-    e = registry.get_entity(feature)
-    if e.entity_type not in [EntityType.DerivedFeature, EntityType.AnchorFeature]:
-        raise HTTPException(
-            status_code=404, detail=f"Feature {feature} not found")
-    return e.to_dict()
+def get_feature(feature: str, request: Request) -> Response:
+    def fetch():
+        e = registry.get_entity(feature)
+        if e.entity_type not in [EntityType.DerivedFeature, EntityType.AnchorFeature]:
+            raise HTTPException(
+                status_code=404, detail=f"Feature {feature} not found")
+        return e.to_dict()
+    return _etag_response(request, ("feature", feature), fetch)
 
 @router.get("/features/{feature}/lineage")
-def get_feature_lineage(feature: str) -> Dict:
-    lineage = registry.get_lineage(feature)
-    return lineage.to_dict()
+def get_feature_lineage(feature: str) -> ORJSONResponse:
+    def fetch():
+        lineage = registry.get_lineage(feature)
+        return lineage.to_dict()
+    return ORJSONResponse(response_cache.get_or_compute(("lineage", feature), fetch))
 
 @router.post("/projects")
 def new_project(definition: Dict) -> Dict:
     id = registry.create_project(ProjectDef(**to_snake(definition)))
+    response_cache.clear()
     return {"guid": str(id)}
 
 
@@ -168,6 +246,7 @@ def new_project(definition: Dict) -> Dict:
 def new_project_datasource(project: str, definition: Dict) -> Dict:
     project_id = registry.get_entity_id(project)
     id = registry.create_project_datasource(project_id, SourceDef(**to_snake(definition)))
+    response_cache.clear()
     return {"guid": str(id)}
 
 
@@ -175,6 +254,7 @@ def new_project_datasource(project: str, definition: Dict) -> Dict:
 def new_project_anchor(project: str, definition: Dict) -> Dict:
     project_id = registry.get_entity_id(project)
     id = registry.create_project_anchor(project_id, AnchorDef(**to_snake(definition)))
+    response_cache.clear()
     return {"guid": str(id)}
 
 
@@ -183,6 +263,7 @@ def new_project_anchor_feature(project: str, anchor: str, definition: Dict) -> D
     project_id = registry.get_entity_id(project)
     anchor_id = registry.get_entity_id(anchor)
     id = registry.create_project_anchor_feature(project_id, anchor_id, AnchorFeatureDef(**to_snake(definition)))
+    response_cache.clear()
     return {"guid": str(id)}
 
 
@@ -190,6 +271,7 @@ def new_project_anchor_feature(project: str, anchor: str, definition: Dict) -> D
 def new_project_derived_feature(project: str, definition: Dict) -> Dict:
     project_id = registry.get_entity_id(project)
     id = registry.create_project_derived_feature(project_id, DerivedFeatureDef(**to_snake(definition)))
+    response_cache.clear()
     return {"guid": str(id)}
 
 
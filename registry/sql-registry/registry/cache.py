@@ -0,0 +1,32 @@
+import threading
+from typing import Any, Callable, Hashable
+
+from cachetools import TTLCache
+
+
+class ResponseCache:
+    """
+    In-process TTL cache for read-mostly API responses.
+    Writes through this instance must call `clear()`, changes made by other instances show up after `ttl` seconds.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 10):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        # Bumped on every `clear()`, so a result computed before a write is never stored after it
+        self.generation = 0
+
+    def get_or_compute(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            generation = self.generation
+        ret = fn()
+        with self.lock:
+            if generation == self.generation:
+                self.cache[key] = ret
+        return ret
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.generation += 1
@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
 import logging
+import queue
+import random
 import threading
+import time
 import os
 from typing import List, Dict
 
@@ -16,19 +19,41 @@ import pymssql
 
 providers = []
 
+# Connection pool settings, `POOL_SIZE` idle connections are kept, up to `POOL_MAX_OVERFLOW` more
+# can be opened under load, callers wait at most `POOL_TIMEOUT_SEC` for a free connection.
+POOL_SIZE = int(os.environ.get("CONNECTION_POOL_SIZE", 20))
+POOL_MAX_OVERFLOW = int(os.environ.get("CONNECTION_POOL_MAX_OVERFLOW", 10))
+POOL_TIMEOUT_SEC = 30
+# Connections opened up front when the registry starts, so the first requests after a deployment don't each pay a handshake
+POOL_WARM_SIZE = min(int(os.environ.get("CONNECTION_POOL_WARM_SIZE", POOL_SIZE)), POOL_SIZE)
+
+# Failed statements are retried up to `RETRY_COUNT` times, but only for errors that can go away by themselves:
+# lost connections (OperationalError), deadlock victims (1205) and Azure SQL throttling/failover (40501, 40613, 49918)
+RETRY_COUNT = 3
+RETRY_BASE_DELAY_SEC = 0.1
+TRANSIENT_ERROR_CODES = {1205, 40501, 40613, 49918}
+
+
+def is_transient_error(e: Exception) -> bool:
+    if isinstance(e, pymssql.OperationalError):
+        return True
+    return bool(e.args) and e.args[0] in TRANSIENT_ERROR_CODES
+
+
+def retry_delay(retry: int) -> float:
+    """
+    Exponential backoff with jitter, so clients hitting the same outage don't retry in lockstep
+    """
+    return RETRY_BASE_DELAY_SEC * (2 ** retry) + random.uniform(0, RETRY_BASE_DELAY_SEC)
+
+
 class DbConnection(ABC):
     @abstractmethod
     def query(self, sql: str, *args, **kwargs) -> List[Dict]:
         pass
 
-# already has one in 'db_registry.py'; shall we remove it?
-'''
-def quote(id):
-    if isinstance(id, str):
-        return f"'{id}'"
-    else:
-        return ",".join([f"'{i}'" for i in id])
-'''
+    def close(self):
+        pass
 
 def parse_conn_str(s: str) -> Dict:
     """
@@ -71,6 +96,9 @@ class SQLiteConnection(DbConnection):
         # this is just to implement the abstract method.
         pass
 
+    def close(self):
+        self.conn.close()
+
     @contextmanager
     def transaction(self):
         """
@@ -108,6 +136,74 @@ class SQLiteConnection(DbConnection):
                 conn.commit()
 
 
+class MssqlConnectionPool:
+    """
+    A minimal pool of pymssql connections, so every call doesn't pay a new TCP/TDS handshake.
+    """
+    def __init__(self, params):
+        self.params = params
+        self.idle = queue.LifoQueue(maxsize=POOL_SIZE)
+        self.slots = threading.BoundedSemaphore(POOL_SIZE + POOL_MAX_OVERFLOW)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection from the pool, it's returned to the pool when the block exits.
+        Connections raising `pymssql.OperationalError` are considered broken and discarded.
+        """
+        if not self.slots.acquire(timeout=POOL_TIMEOUT_SEC):
+            raise TimeoutError("Timed out waiting for a database connection")
+        conn = None
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = pymssql.connect(**self.params)
+            yield conn
+        except pymssql.OperationalError:
+            self._close(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                try:
+                    self.idle.put_nowait(conn)
+                except queue.Full:
+                    self._close(conn)
+            self.slots.release()
+
+    def warm_up(self, size: int):
+        """
+        Open idle connections until there are `size` of them, connection errors are raised to the caller
+        """
+        while self.idle.qsize() < size:
+            conn = pymssql.connect(**self.params)
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                self._close(conn)
+                return
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        while True:
+            try:
+                self._close(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def _close(conn):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 class MssqlConnection(DbConnection):
     @staticmethod
     def connect(autocommit = True):
@@ -122,34 +218,36 @@ class MssqlConnection(DbConnection):
 
     def __init__(self, params):
         self.params = params
-        self.make_connection()
-        self.mutex = threading.Lock()
+        self.pool = MssqlConnectionPool(params)
+        # Transactions need `autocommit` disabled, keep them in a separate pool
+        self.transaction_pool = MssqlConnectionPool({**params, "autocommit": False})
+        # Make sure we can connect, and pre-open the pool while at it
+        self.pool.warm_up(max(POOL_WARM_SIZE, 1))
 
-    def make_connection(self):
-        self.conn = pymssql.connect(**self.params)
+    def close(self):
+        self.pool.close()
+        self.transaction_pool.close()
 
     def query(self, sql: str, *args, **kwargs) -> List[Dict]:
         """
         Make SQL query and return result
         """
         logging.debug(f"SQL: `{sql}`")
-        # NOTE: Only one cursor is allowed at the same time
         retry = 0
         while True:
             try:
-                with self.mutex:
-                    c = self.conn.cursor(as_dict=True)
+                with self.pool.connection() as conn:
+                    c = conn.cursor(as_dict=True)
                     c.execute(sql, *args, **kwargs)
                     return c.fetchall()
-            except pymssql.OperationalError:
-                logging.warning("Database error, retrying...")
-                # Reconnect
-                self.make_connection()
+            except pymssql.DatabaseError as e:
                 retry += 1
-                if retry >= 3:
+                if retry >= RETRY_COUNT or not is_transient_error(e):
                     # Stop retrying
                     raise
-                pass
+                logging.warning("Database error, retrying...")
+                # A broken connection has been discarded, next attempt uses another one
+                time.sleep(retry_delay(retry))
 
     @contextmanager
     def transaction(self):
@@ -171,21 +269,15 @@ class MssqlConnection(DbConnection):
                 c.close(...)
         ```
         """
-        conn = None
-        cursor = None
-        try:
-            # As one MssqlConnection has only one connection, we need to create a new one to disable `autocommit`
-            conn = MssqlConnection.connect(autocommit=False).conn
+        with self.transaction_pool.connection() as conn:
             cursor = conn.cursor(as_dict=True)
-            yield cursor
-        except Exception as e:
-            logging.warning(f"Exception: {e}")
-            if conn:
+            try:
+                yield cursor
+            except Exception as e:
+                logging.warning(f"Exception: {e}")
                 conn.rollback()
-            raise e
-        finally:
-            if conn:
-                conn.commit()
+                raise e
+            conn.commit()
 
 
 # This is ordered list. So append SQLite first
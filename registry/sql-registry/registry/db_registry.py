@@ -1,12 +1,18 @@
-from typing import Optional, Tuple, Union
+from typing import Callable, Optional, Tuple, Union
 from uuid import UUID, uuid4
-from typing import List, Set, Dict
+from typing import Iterator, List, Set, Dict
 from pydantic import UUID4
 from registry import Registry
 from registry import connect
+from registry.database import POOL_MAX_OVERFLOW, POOL_SIZE, POOL_TIMEOUT_SEC
 from registry.models import AnchorAttributes, AnchorDef, AnchorFeatureAttributes, AnchorFeatureDef, DerivedFeatureAttributes, DerivedFeatureDef, Edge, EntitiesAndRelations, Entity, EntityRef, EntityType, ProjectAttributes, ProjectDef, RelationshipType, SourceAttributes, SourceDef, _to_type, _to_uuid
-import json
+import orjson
+import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from cachetools import TTLCache
 class ConflictError(Exception):
     pass
 
@@ -15,10 +21,10 @@ class ConflictError(Exception):
 # Eventually we might want to move to ORM based SQL access ways, but need to make sure it also works well in multi-threading
 # Currently the ORM based access way is only used in Sandbox so it's safe
 
-from sqlalchemy.orm import Session
-from sqlalchemy.orm.query import Query
-from sqlalchemy import and_
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import and_, or_
 import sqlalchemy as db
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 class Entities(Base):
@@ -40,70 +46,218 @@ class Edges(Base):
     conn_type = db.Column('conn_type', db.String(20), nullable=False) 
 
 
-def quote(id):
-    if isinstance(id, str):
-        return f"'{id}'"
-    if isinstance(id, UUID):
-        return f"'{str(id)}'"
+def _to_entity(row) -> Entity:
+    """
+    Build an entity from a row of `entity_id, qualified_name, entity_type, attributes`, without modifying the row.
+    `attributes` is either the JSON text from the DB or a dict already parsed from it, `Entity` copies the dict.
+    """
+    attributes = row["attributes"]
+    if isinstance(attributes, (str, bytes)):
+        attributes = orjson.loads(attributes)
+    return Entity(row["entity_id"], row["qualified_name"], row["entity_type"], attributes)
+
+def _batch_uuids(n: int) -> List[str]:
+    """
+    Generate `n` random (version 4) UUIDs from a single read of the OS random source instead of one per `uuid4()` call
+    """
+    buf = os.urandom(16 * n)
+    return [str(UUID(bytes=buf[i * 16:(i + 1) * 16], version=4)) for i in range(n)]
+
+# Edges inserted per statement, well under the SQL Server limit of 2100 parameters
+EDGE_INSERT_BATCH_SIZE = 500
+
+# Lineage and dependency walks stop this many edges away from where they start, below SQL Server's default
+# limit of 100 recursion levels, so a cycle in the graph ends the walk instead of failing the query
+MAX_TRAVERSAL_DEPTH = 64
+
+# Threads used to run independent queries of one call side by side on SQL Server, e.g. both directions of a lineage.
+# Sized like the API request threadpool, so concurrent requests don't queue for these threads
+QUERY_WORKERS = int(os.environ.get("REGISTRY_THREADPOOL_SIZE", 100))
+
+# Qualified names are resolved to ids on every write, and entity rows never change once written.
+# Cached names and rows are dropped on delete here, and expire after this many seconds in case
+# the entity was deleted (or deleted and created again) through another instance.
+# Same setting as the response cache in main.py, so other instances' writes show up within one bound
+ENTITY_ID_CACHE_TTL_SEC = float(os.environ.get("REGISTRY_RESPONSE_CACHE_TTL", 10))
+
+DEFAULT_SANDBOX_REGISTRY_URL = 'sqlite:////tmp/feathr_registry.sqlite?check_same_thread=False' #Create test.sqlite automatically
+
+def _sandbox_tables(metadata: db.MetaData) -> Tuple[db.Table, db.Table]:
+    entities_table = db.Table('entities', metadata,
+                db.Column('entity_id', db.String(50),nullable=False, primary_key=True),
+                db.Column('qualified_name', db.String(200), nullable=False),
+                db.Column('entity_type', db.String(100),nullable=False),
+                db.Column('attributes', db.String(2000), nullable=False), #TODO: sqlite doesn't enforce length but others might
+                # Same as `ix_entities_type_name` in scripts/schema.sql, keyword search scans this instead of the table
+                db.Index('ix_entities_type_name', 'entity_type', 'qualified_name'),
+                db.Index('ix_entities_qualified_name', 'qualified_name', unique=True),
+                )
+    edges_table = db.Table('edges', metadata,
+                db.Column('edge_id', db.String(50),nullable=False, primary_key=True),
+                db.Column('from_id', db.String(50), nullable=False),
+                db.Column('to_id', db.String(20), nullable=False),
+                db.Column('conn_type', db.String(20), nullable=False),
+                # Same as `ux_edges_from_conn_to` and `ix_edges_to_conn` in scripts/schema.sql, SQLite has no `include` columns
+                db.Index('ux_edges_from_conn_to', 'from_id', 'conn_type', 'to_id', unique=True),
+                db.Index('ix_edges_to_conn', 'to_id', 'conn_type'),
+                )
+    return entities_table, edges_table
+
+def _insert_edge_if_missing(edges_table: db.Table, dialect: str) -> db.sql.expression.Executable:
+    """
+    Insert an edge unless the same connection already exists, in the form the sandbox database understands
+    """
+    if dialect == "sqlite":
+        return db.insert(edges_table).prefix_with("OR IGNORE")
+    if dialect in ("mysql", "mariadb"):
+        return db.insert(edges_table).prefix_with("IGNORE")
+    if dialect == "postgresql":
+        return postgresql.insert(edges_table).on_conflict_do_nothing()
+    # Anything else, e.g. SQL Server, gets the same `not exists` check the MSSQL code path uses
+    c = edges_table.c
+    row = db.select(*[db.bindparam(col.name, type_=col.type) for col in (c.edge_id, c.from_id, c.to_id, c.conn_type)])
+    exists = db.exists().where(c.from_id == db.bindparam("from_id"), c.to_id == db.bindparam("to_id"), c.conn_type == db.bindparam("conn_type"))
+    return db.insert(edges_table).from_select(["edge_id", "from_id", "to_id", "conn_type"], row.where(~exists))
+
+def _reachable_edges_query(edges_table: db.Table) -> db.sql.expression.Executable:
+    """
+    Same recursive walk as the SQL Server query in `_get_reachable_edges`, built with SQLAlchemy constructs
+    so the `with recursive`, string concatenation and `like` are rendered for whichever database the sandbox uses
+    """
+    c = edges_table.c
+    # Databases like MySQL type the CTE columns after its first part, give the path room for a full-depth walk
+    # of ids up to 50 characters each plus a separator
+    path = db.String((MAX_TRAVERSAL_DEPTH + 1) * 51)
+    start = db.select(c.edge_id, c.from_id, c.to_id, c.conn_type,
+                      db.literal(1).label("depth"),
+                      db.cast("/" + c.from_id + "/" + c.to_id + "/", path).label("path"),
+                      db.case((c.from_id == c.to_id, 1), else_=0).label("cycle"),
+                      ).where(c.from_id == db.bindparam("id"), c.conn_type == db.bindparam("type"))
+    reach = start.cte("reach", recursive=True)
+    step = db.select(c.edge_id, c.from_id, c.to_id, c.conn_type,
+                     reach.c.depth + 1,
+                     db.cast(reach.c.path + c.to_id + "/", path),
+                     db.case((reach.c.path.contains("/" + c.to_id + "/"), 1), else_=0),
+                     ).join(reach, c.from_id == reach.c.to_id).where(c.conn_type == db.bindparam("type"),
+                                                                     reach.c.depth < db.bindparam("max_depth"),
+                                                                     reach.c.cycle == 0)
+    reach = reach.union_all(step)
+    return db.select(reach.c.edge_id, reach.c.from_id, reach.c.to_id, reach.c.conn_type).distinct()
+
+def _sandbox_statements(entities_table: db.Table, edges_table: db.Table, dialect: str) -> Dict[str, db.sql.expression.Executable]:
+    """
+    Statements run on every request, built once with bind parameters instead of on every call
+    """
+    e = entities_table.c
+    edge_columns = (edges_table.c.edge_id, edges_table.c.from_id, edges_table.c.to_id, edges_table.c.conn_type)
+    # `expanding` parameters take a list of any length, the statement is still compiled only once
+    ids = db.bindparam("ids", expanding=True)
+    types = db.bindparam("types", expanding=True)
+    return {
+        "get_projects": db.select(e.entity_id, e.qualified_name).where(e.entity_type == str(EntityType.Project)),
+        "get_entity_id": db.select(e.entity_id).where(e.qualified_name == db.bindparam("qualified_name")),
+        "get_entity": db.select(e.entity_id, e.qualified_name, e.entity_type, e.attributes).where(e.entity_id == db.bindparam("entity_id")),
+        "get_neighbors": db.select(edges_table.c.edge_id, edges_table.c.from_id, edges_table.c.to_id, edges_table.c.conn_type).where((edges_table.c.from_id == db.bindparam("from_id")) & (edges_table.c.conn_type == db.bindparam("conn_type"))),
+        "get_entities": db.select(e.entity_id, e.qualified_name, e.entity_type, e.attributes).where(e.entity_id.in_(ids)),
+        "get_edges_from": db.select(*edge_columns).where(edges_table.c.from_id.in_(ids)),
+        "get_edges_from_by_type": db.select(*edge_columns).where(edges_table.c.from_id.in_(ids) & edges_table.c.conn_type.in_(types)),
+        "get_entity_by_name": db.select(e.entity_id, e.entity_type, e.attributes).where(e.qualified_name == db.bindparam("qualified_name")),
+        "get_reachable_edges": _reachable_edges_query(edges_table),
+        "insert_entity": db.insert(entities_table),
+        # Skips edges that already exist
+        "insert_edge": _insert_edge_if_missing(edges_table, dialect),
+    }
+
+@lru_cache(maxsize=None)
+def _get_sandbox_engine(url: str) -> Tuple[db.engine.Engine, db.Table, db.Table]:
+    """
+    Engines and tables are created once per URL, the schema doesn't change at runtime,
+    so later registries on the same database skip the table existence checks in `create_all`
+    """
+    parsed_url = db.engine.make_url(url)
+    # Pooled connections are handed to whichever thread asks next, SQLite refuses that unless `check_same_thread` is off
+    connect_args = {"check_same_thread": False} if parsed_url.get_backend_name() == "sqlite" else {}
+    if parsed_url.database in (None, "", ":memory:"):
+        # Every connection to an in-memory database gets its own empty database, share a single one between all threads
+        engine = db.create_engine(url, poolclass=db.pool.StaticPool, connect_args=connect_args)
     else:
-        return ",".join([quote(i) for i in id])
+        # Same pool settings as the MSSQL connections, so concurrent requests don't queue behind one connection
+        engine = db.create_engine(url, poolclass=db.pool.QueuePool, pool_size=POOL_SIZE,
+                                  max_overflow=POOL_MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT_SEC,
+                                  connect_args=connect_args)
+    metadata = db.MetaData()
+    entities_table, edges_table = _sandbox_tables(metadata)
+    metadata.create_all(engine) #Creates the table
+    # `create_all` skips the indexes of tables that already exist, add the ones missing from older databases
+    for index in list(entities_table.indexes) + list(edges_table.indexes):
+        try:
+            index.create(engine, checkfirst=True)
+        except db.exc.IntegrityError:
+            # Databases written before the unique indexes may hold duplicates, keep working without the index
+            logging.warning(f"Cannot create unique index {index.name}, the existing data has duplicates")
+    return engine, entities_table, edges_table
 
 class DbRegistry(Registry):
     def __init__(self):
         self.conn = connect()
+        self._entity_id_cache = TTLCache(maxsize=4096, ttl=ENTITY_ID_CACHE_TTL_SEC)
+        # Rows with parsed attributes rather than `Entity` objects, callers fill in and modify the entities they get
+        self._entity_row_cache = TTLCache(maxsize=16384, ttl=ENTITY_ID_CACHE_TTL_SEC)
+        self._entity_id_lock = threading.Lock()
+        # Sandbox queries run inline, SQLite connections may only be used by the thread that opened them
+        self._executor = None
         if os.environ.get("FEATHR_SANDBOX"):
             sandbox_registry_url = os.environ.get("FEATHR_SANDBOX_REGISTRY_URL")
             if sandbox_registry_url:
                 print(f"FEATHR_SANDBOX_REGISTRY_URL is set to {sandbox_registry_url}. Please refer to https://docs.sqlalchemy.org/en/20/core/engines.html#database-urls for how to construct the URLs.")
-                engine = db.create_engine(sandbox_registry_url)
             else:
-                engine = db.create_engine('sqlite:////tmp/feathr_registry.sqlite?check_same_thread=False') #Create test.sqlite automatically
-            self.sql_session = Session(engine)
-            self.connection = engine.connect()
-            metadata = db.MetaData()
-
-
-            self.entities_table = db.Table('entities', metadata,
-                        db.Column('entity_id', db.String(50),nullable=False, primary_key=True),
-                        db.Column('qualified_name', db.String(200), nullable=False),
-                        db.Column('entity_type', db.String(100),nullable=False),
-                        db.Column('attributes', db.String(2000), nullable=False) #TODO: sqlite doesn't enforce length but others might
-                        )
-            self.edges_table = db.Table('edges', metadata,
-                        db.Column('edge_id', db.String(50),nullable=False, primary_key=True),
-                        db.Column('from_id', db.String(50), nullable=False),
-                        db.Column('to_id', db.String(20), nullable=False),
-                        db.Column('conn_type', db.String(20), nullable=False) 
-                        )
-            metadata.create_all(engine) #Creates the table
-    def _fetch_helper(self, query):
-        """serves as a function to have max code similarity between the ORM based code and the SQL based code. Basically fetch all and return a dict (otherwise it might just return a list of `LegacyRow` object)
-        """
-        # 
-        
-        if isinstance(query, Query):
-            # if this is already a query object, execute it
-            r = query.all()
+                sandbox_registry_url = DEFAULT_SANDBOX_REGISTRY_URL
+            self.engine, self.entities_table, self.edges_table = _get_sandbox_engine(sandbox_registry_url)
+            self.statements = _sandbox_statements(self.entities_table, self.edges_table, self.engine.dialect.name)
+            # Requests run on many threads, each gets its own session, connections are borrowed from the engine's pool per call
+            self.sql_session = scoped_session(sessionmaker(bind=self.engine))
         else:
-            # otherwise need a session to execute it
-            r = self.connection.execute(query).fetchall()
-        r = [ele._asdict() for ele in r]
-        return r
+            self._executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="registry-query")
+    def close(self):
+        """
+        Release the database connections held by this registry
+        """
+        if self._executor:
+            self._executor.shutdown()
+        if os.environ.get("FEATHR_SANDBOX"):
+            self.sql_session.remove()
+        self.conn.close()
+
+    def _fetch_helper(self, query, params: Optional[Dict] = None):
+        """serves as a function to have max code similarity between the ORM based code and the SQL based code. Basically fetch all and return read-only mappings (otherwise it might just return a list of `LegacyRow` object)
+        The mappings are views over the fetched rows, so no dict is built per row, callers must not modify them.
+        Reads are Core `select` statements run on a borrowed connection, the ORM session is only used to delete.
+        """
+        with self.engine.connect() as conn:
+            if params:
+                return conn.execute(query, params).mappings().all()
+            return conn.execute(query).mappings().all()
+
+    def _map(self, fn: Callable, items: List) -> List:
+        """
+        `fn` applied to every item, side by side on SQL Server and one after another on sandbox engines
+        """
+        if self._executor is None:
+            return [fn(item) for item in items]
+        return list(self._executor.map(fn, items))
 
     def get_projects(self) -> List[str]:
         if os.environ.get("FEATHR_SANDBOX"):
-            query = db.select(self.entities_table.c.qualified_name).where((self.entities_table.c.entity_type == str(EntityType.Project))) 
-            ret = self._fetch_helper(query)
+            ret = self._fetch_helper(self.statements["get_projects"])
         else:
             ret = self.conn.query(
             f"select qualified_name from entities where entity_type=%s", str(EntityType.Project))
-        return list([r["qualified_name"] for r in ret])
+        return [r["qualified_name"] for r in ret]
     
     def get_projects_ids(self) -> Dict:
         projects = {}
         if os.environ.get("FEATHR_SANDBOX"):
-            query = db.select(self.entities_table.c.entity_id,self.entities_table.c.qualified_name).where((self.entities_table.c.entity_type == str(EntityType.Project))) 
-            ret = self._fetch_helper(query)
+            ret = self._fetch_helper(self.statements["get_projects"])
         else:
             ret = self.conn.query(
             f"select entity_id, qualified_name from entities where entity_type=%s", str(EntityType.Project))
@@ -112,10 +266,96 @@ class DbRegistry(Registry):
         return projects
 
     def get_entity(self, id_or_name: Union[str, UUID]) -> Entity:
-        return self._fill_entity(self._get_entity(id_or_name))
+        return self._fill_entities([self._get_entity(id_or_name)])[0]
 
     def get_entities(self, ids: List[UUID]) -> List[Entity]:
-        return list([self._fill_entity(e) for e in self._get_entities(ids)])
+        return self._fill_entities(self._get_entities(ids))
+
+    def get_project_datasources(self, project: Union[str, UUID]) -> List[Entity]:
+        project_id = self.get_entity_id(project)
+        if os.environ.get("FEATHR_SANDBOX"):
+            query = db.select(Entities.entity_id, Entities.qualified_name, Entities.entity_type, Entities.attributes).join(Edges, and_(Entities.entity_id == Edges.to_id, Edges.conn_type == RelationshipType.Contains.name)).where(Edges.from_id == str(project_id), Entities.entity_type == str(EntityType.Source))
+            rows = self._fetch_helper(query)
+        else:
+            rows = self.conn.query(fr'''select entity_id, qualified_name, entity_type, attributes
+                from entities
+                inner join edges on entity_id = edges.to_id and edges.conn_type = %s
+                where edges.from_id = %s and entity_type = %s
+            ''', (RelationshipType.Contains.name, str(project_id), str(EntityType.Source)))
+        return [_to_entity(row) for row in rows]
+
+    def get_project_datasource(self, project: Union[str, UUID], datasource: Union[str, UUID]) -> Optional[Entity]:
+        project_id = self.get_entity_id(project)
+        if os.environ.get("FEATHR_SANDBOX"):
+            query = db.select(Entities.entity_id, Entities.qualified_name, Entities.entity_type, Entities.attributes).join(Edges, and_(Entities.entity_id == Edges.to_id, Edges.conn_type == RelationshipType.Contains.name)).where(Edges.from_id == str(project_id), Entities.entity_id == str(datasource), Entities.entity_type == str(EntityType.Source))
+            rows = self._fetch_helper(query)
+        else:
+            rows = self.conn.query(fr'''select entity_id, qualified_name, entity_type, attributes
+                from entities
+                inner join edges on entity_id = edges.to_id and edges.conn_type = %s
+                where edges.from_id = %s and entity_id = %s and entity_type = %s
+            ''', (RelationshipType.Contains.name, str(project_id), str(datasource), str(EntityType.Source)))
+        if not rows:
+            return None
+        return _to_entity(rows[0])
+
+    def get_project_features(self,
+                             project: Union[str, UUID],
+                             keyword: Optional[str] = None,
+                             start: Optional[int] = None,
+                             size: Optional[int] = None) -> List[Entity]:
+        return list(self.iter_project_features(project, keyword, start, size))
+
+    def iter_project_features(self,
+                              project: Union[str, UUID],
+                              keyword: Optional[str] = None,
+                              start: Optional[int] = None,
+                              size: Optional[int] = None) -> Iterator[Entity]:
+        """
+        Same as `get_project_features`, but entities are built and filled one at a time as the result is consumed.
+        The rows are fetched before returning, so lookup errors are raised here rather than while iterating.
+        """
+        project_id = self.get_entity_id(project)
+        types = tuple([str(EntityType.AnchorFeature), str(EntityType.DerivedFeature)])
+        if os.environ.get("FEATHR_SANDBOX"):
+            query = db.select(Entities.entity_id, Entities.qualified_name, Entities.entity_type, Entities.attributes).join(Edges, and_(Entities.entity_id == Edges.from_id, Edges.conn_type == RelationshipType.BelongsTo.name)).where(Edges.to_id == str(project_id), Entities.entity_type.in_(types))
+            if keyword:
+                query = query.where(Entities.qualified_name.ilike("%" + keyword + "%"))
+            query = query.order_by(Entities.qualified_name)
+            if start is not None and size is not None:
+                query = query.offset(int(start)).limit(int(size))
+            rows = self._fetch_helper(query)
+        else:
+            sql = fr'''select entity_id, qualified_name, entity_type, attributes
+                from entities
+                inner join edges on entity_id = edges.from_id and edges.conn_type = %(conn_type)s
+                where edges.to_id = %(project_id)s and entity_type in %(types)s'''
+            if keyword:
+                sql += " and qualified_name like %(keyword)s"
+            sql += " order by qualified_name"
+            if start is not None and size is not None:
+                sql += " offset %(start)s rows fetch next %(size)s rows only"
+            rows = self.conn.query(sql, {
+                "conn_type": RelationshipType.BelongsTo.name,
+                "project_id": str(project_id),
+                "types": types,
+                "keyword": f"%{keyword}%",
+                "start": int(start or 0),
+                "size": int(size or 0),
+            })
+        # Fill the inputs of all derived features with two queries up front instead of two per feature
+        derived_ids = [row["entity_id"] for row in rows if row["entity_type"] == str(EntityType.DerivedFeature)]
+        edges = self._get_out_edges(derived_ids, [RelationshipType.Consumes])
+        input_map = dict([(e.id, e) for e in self._get_entities(list(set([e.to_id for e in edges])))])
+        inputs = {}
+        for e in edges:
+            inputs.setdefault(e.from_id, []).append(input_map[e.to_id])
+
+        def fill(e: Entity) -> Entity:
+            if e.entity_type == EntityType.DerivedFeature:
+                e.attributes.input_features = inputs.get(e.id, [])
+            return e
+        return (fill(_to_entity(row)) for row in rows)
 
     def get_entity_id(self, id_or_name: Union[str, UUID]) -> UUID:
         try:
@@ -124,20 +364,28 @@ class DbRegistry(Registry):
         except ValueError:
             pass
         # It is a name
+        with self._entity_id_lock:
+            id = self._entity_id_cache.get(id_or_name)
+        if id is not None:
+            return id
         if os.environ.get("FEATHR_SANDBOX"):
-            query = db.select(self.entities_table.c.entity_id).where((self.entities_table.c.qualified_name == str(id_or_name))) 
-            ret = self._fetch_helper(query)
+            ret = self._fetch_helper(self.statements["get_entity_id"], {"qualified_name": str(id_or_name)})
         else:
             ret = self.conn.query(
             f"select entity_id from entities where qualified_name=%s", str(id_or_name))
         if len(ret) == 0:
             raise KeyError(f"Entity {id_or_name} not found")
-        return ret[0]["entity_id"]
+        id = ret[0]["entity_id"]
+        with self._entity_id_lock:
+            self._entity_id_cache[id_or_name] = id
+        return id
 
     def get_neighbors(self, id_or_name: Union[str, UUID], relationship: RelationshipType) -> List[Edge]:
         if os.environ.get("FEATHR_SANDBOX"):
-            query = db.select(self.edges_table.c.edge_id, self.edges_table.c.from_id, self.edges_table.c.to_id,self.edges_table.c.conn_type).where((self.edges_table.c.from_id == str(self.get_entity_id(id_or_name))) & (self.edges_table.c.conn_type == relationship.name)) 
-            rows = self._fetch_helper(query)
+            rows = self._fetch_helper(self.statements["get_neighbors"], {
+                "from_id": str(self.get_entity_id(id_or_name)),
+                "conn_type": relationship.name,
+            })
         else:
             rows = self.conn.query(fr'''
             select edge_id, from_id, to_id, conn_type
@@ -145,7 +393,7 @@ class DbRegistry(Registry):
             where from_id = %s
             and conn_type = %s
         ''', (str(self.get_entity_id(id_or_name)), relationship.name))
-        return list([Edge(**row) for row in rows])
+        return [Edge(**row) for row in rows]
 
     def get_lineage(self, id_or_name: Union[str, UUID]) -> EntitiesAndRelations:
         """
@@ -153,10 +401,9 @@ class DbRegistry(Registry):
         Returns [entity_id:entity] map and list of edges have been traversed.
         """
         id = self.get_entity_id(id_or_name)
-        upstream_entities, upstream_edges = self._bfs(
-            id, RelationshipType.Consumes)
-        downstream_entities, downstream_edges = self._bfs(
-            id, RelationshipType.Produces)
+        # Both directions are independent, walk them at the same time
+        (upstream_entities, upstream_edges), (downstream_entities, downstream_edges) = self._map(
+            lambda conn_type: self._bfs(id, conn_type), [RelationshipType.Consumes, RelationshipType.Produces])
         return EntitiesAndRelations(
             upstream_entities + downstream_entities,
             upstream_edges + downstream_edges)
@@ -166,27 +413,29 @@ class DbRegistry(Registry):
         This function returns not only the project itself, but also everything in the project
         """
         project = self._get_entity(id_or_name)
-        edges = set(self.get_neighbors(id_or_name, RelationshipType.Contains))
-        ids = list([e.to_id for e in edges])
-        children = self._get_entities(ids)
+        edges, children = self._get_contained(project.id)
+        edges = set(edges)
+        ids = [e.to_id for e in edges]
         child_map = dict([(e.id, e) for e in children])
         project.attributes.children = children
+        # All edges between the children are returned anyway, the anchors and derived features are filled from them
+        # instead of querying their outgoing edges separately
+        all_edges = self._get_edges(ids)
+        neighbors = {}
+        for e in all_edges:
+            neighbors.setdefault((e.from_id, e.conn_type), []).append(e)
         for anchor in project.attributes.anchors:
-            conn = self.get_neighbors(anchor.id, RelationshipType.Contains)
+            conn = neighbors.get((anchor.id, RelationshipType.Contains), [])
             feature_ids = [e.to_id for e in conn]
-            edges = edges.union(conn)
-            features = list([child_map[id] for id in feature_ids])
+            features = [child_map[id] for id in feature_ids]
             anchor.attributes.features = features
-            source_id = self.get_neighbors(
-                anchor.id, RelationshipType.Consumes)[0].to_id
+            source_id = neighbors.get((anchor.id, RelationshipType.Consumes), [])[0].to_id
             anchor.attributes.source = child_map[source_id]
         for df in project.attributes.derived_features:
-            conn = self.get_neighbors(df.id, RelationshipType.Consumes)
+            conn = neighbors.get((df.id, RelationshipType.Consumes), [])
             input_ids = [e.to_id for e in conn]
-            edges = edges.union(conn)
-            features = list([child_map[id] for id in input_ids])
+            features = [child_map[id] for id in input_ids]
             df.attributes.input_features = features
-        all_edges = self._get_edges(ids)
         return EntitiesAndRelations([project] + children, list(edges.union(all_edges)))
     
     def get_dependent_entities(self, entity_id: Union[str, UUID]) -> List[Entity]:
@@ -194,39 +443,38 @@ class DbRegistry(Registry):
         Given entity id, returns list of all entities that are downstream/dependant on the given entity
         """
         entity_id = self.get_entity_id(entity_id)
-        entity = self.get_entity(entity_id)
-        downstream_entities = []
-        if entity.entity_type == EntityType.Project:
-            downstream_entities, _ = self._bfs(entity_id, RelationshipType.Contains)
-        if entity.entity_type == EntityType.Source:
-            downstream_entities, _ = self._bfs(entity_id, RelationshipType.Produces)
-        if entity.entity_type == EntityType.Anchor:
-            downstream_entities, _ = self._bfs(entity_id, RelationshipType.Contains)
-        if entity.entity_type in (EntityType.AnchorFeature, EntityType.DerivedFeature):
-            downstream_entities, _ = self._bfs(entity_id, RelationshipType.Produces)
-        return [e for e in downstream_entities if str(e.id) != str(entity_id)]
+        # Only the type is needed here, no need to fill the entity
+        entity = self._get_entity(entity_id)
+        if entity.entity_type in (EntityType.Project, EntityType.Anchor):
+            ids = self._get_downstream_ids(entity_id, RelationshipType.Contains)
+        elif entity.entity_type in (EntityType.Source, EntityType.AnchorFeature, EntityType.DerivedFeature):
+            ids = self._get_downstream_ids(entity_id, RelationshipType.Produces)
+        else:
+            return []
+        ids.discard(str(entity_id))
+        return self.get_entities(ids)
     
-    def delete_empty_entities(self, entities: List[Entity]):
+    def delete_empty_entities(self, entities: List[Entity]) -> bool:
         """
         Given entity list, deleting all anchors that have no features and all sources that have no anchors.
+        Returns True if any entity has been deleted.
         """
+        deleted = False
         if len(entities) == 0:
-            return
+            return deleted
         
-        # clean up empty anchors
-        for e in entities:
-            if e.entity_type == EntityType.Anchor:
-                downstream_entities, _ = self._bfs(e.id, RelationshipType.Contains) 
-                if len(downstream_entities) == 1: # only anchor itself
-                    self.delete_entity(e.id)
-        # clean up empty sources
-        for e in entities:
-            if e.entity_type == EntityType.Source:
-                downstream_entities, _ = self._bfs(e.id, RelationshipType.Produces) 
-                if len(downstream_entities) == 1: # only source itself
+        # clean up empty anchors, then empty sources as deleting an anchor can leave its source empty
+        for entity_type, conn_type in ((EntityType.Anchor, RelationshipType.Contains),
+                                       (EntityType.Source, RelationshipType.Produces)):
+            candidates = [e for e in entities if e.entity_type == entity_type]
+            # Check all candidates at the same time, then delete the empty ones
+            downstream = self._map(lambda e: self._get_downstream_ids(e.id, conn_type), candidates)
+            for e, ids in zip(candidates, downstream):
+                if not ids - {str(e.id)}:
                     self.delete_entity(e.id)
+                    deleted = True
 
-        return
+        return deleted
         
     def delete_entity(self, entity_id: Union[str, UUID]):
         """
@@ -236,6 +484,13 @@ class DbRegistry(Registry):
         with self.conn.transaction() as c:
                 self._delete_all_entity_edges(c, entity_id)
                 self._delete_entity(c, entity_id)
+                if os.environ.get("FEATHR_SANDBOX"):
+                    # Edges and entity go away together in one commit
+                    self.sql_session.commit()
+        # Only the id is known here, deletes are rare enough to just drop all cached names
+        with self._entity_id_lock:
+            self._entity_id_cache.clear()
+            self._entity_row_cache.pop(str(entity_id), None)
 
     def search_entity(self,
                       keyword: str,
@@ -246,48 +501,47 @@ class DbRegistry(Registry):
         """
         WARN: This search function is implemented via `like` operator, which could be extremely slow.
         """
-        
-        top_clause = ""
-        if start is not None and size is not None:
-            top_clause = f"TOP({int(start) + int(size)})"
-            
-        if project:
-            project_id = self.get_entity_id(project)
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = self.sql_session.query(Entities.entity_id.label("id"),  Entities.qualified_name, Entities.entity_type.label("type")).join(Edges, and_(Entities.entity_id==Edges.from_id, Edges.conn_type=='BelongsTo')).filter(Edges.to_id==str(project_id), Entities.qualified_name.ilike("%" + keyword + "%"), Entities.entity_type.in_(tuple([str(t) for t in type]))).order_by(Entities.qualified_name).slice(int(start), int(start + size))
-                rows = self._fetch_helper(query)
-            else:
-                sql = fr'''select {top_clause} entity_id as id, qualified_name, entity_type as type
-                    from entities
-                    inner join edges on entity_id=edges.from_id and edges.conn_type='BelongsTo'
-                    where
-                    edges.to_id=%s and qualified_name like %s and entity_type in %s
-                    order by qualified_name'''
-                rows = self.conn.query(sql, (str(project_id), '%' + keyword + '%', tuple([str(t) for t in type])))
-                
+        # Callers may repeat a type, keep each once and in order so the same request always binds the same list
+        types = tuple(dict.fromkeys(str(t) for t in type))
+        paged = start is not None and size is not None
+        project_id = self.get_entity_id(project) if project else None
+        if os.environ.get("FEATHR_SANDBOX"):
+            query = db.select(Entities.entity_id.label("id"), Entities.qualified_name, Entities.entity_type.label("type"))
+            if project:
+                query = query.join(Edges, and_(Entities.entity_id == Edges.from_id, Edges.conn_type == RelationshipType.BelongsTo.name)).where(Edges.to_id == str(project_id))
+            query = query.where(Entities.qualified_name.ilike("%" + keyword + "%"), Entities.entity_type.in_(types)).order_by(Entities.qualified_name)
+            if paged:
+                query = query.offset(int(start)).limit(int(size))
+            rows = self._fetch_helper(query)
         else:
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = self.sql_session.query(Entities.entity_id.label("id"),  Entities.qualified_name, Entities.entity_type.label("type")).filter(Entities.qualified_name.ilike("%" + keyword + "%"), Entities.entity_type.in_(tuple([str(t) for t in type]))).order_by(Entities.qualified_name).slice(int(start), int(start + size))
-                rows = self._fetch_helper(query)
-            else:
-                sql = fr'''select {top_clause} entity_id as id, qualified_name, entity_type as type from entities where qualified_name like %s and entity_type in %s order by qualified_name'''
-                rows = self.conn.query(sql, ('%' + keyword + '%', tuple([str(t) for t in type])))
-        if size:
-            rows = rows[-size:]
-        return list([EntityRef(**row) for row in rows])
+            sql = fr'''select entity_id as id, qualified_name, entity_type as type
+                from entities'''
+            if project:
+                sql += " inner join edges on entity_id = edges.from_id and edges.conn_type = %(conn_type)s"
+            sql += " where qualified_name like %(keyword)s and entity_type in %(types)s"
+            if project:
+                sql += " and edges.to_id = %(project_id)s"
+            sql += " order by qualified_name"
+            # Skip to the requested page on the server instead of fetching every row before it
+            if paged:
+                sql += " offset %(start)s rows fetch next %(size)s rows only"
+            rows = self.conn.query(sql, {
+                "conn_type": RelationshipType.BelongsTo.name,
+                "project_id": str(project_id),
+                "keyword": f"%{keyword}%",
+                "types": types,
+                "start": int(start or 0),
+                "size": int(size or 0),
+            })
+        return [EntityRef(**row) for row in rows]
 
     def create_project(self, definition: ProjectDef) -> UUID:
         # Here we start a transaction, any following step failed, everything rolls back
         definition.qualified_name = definition.name
         with self.conn.transaction() as c:
-            # First we try to find existing entity with the same qualified name
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.select(self.entities_table.c.entity_id, self.entities_table.c.entity_type, self.entities_table.c.attributes).where((self.entities_table.c.qualified_name == definition.qualified_name)) 
-                r = self._fetch_helper(query)
-            else:
-                c.execute(f'''select entity_id, entity_type, attributes from entities where qualified_name = %s''',
-                        definition.qualified_name)
-                r = c.fetchall()
+            id = uuid4()
+            # Insert the new entity unless one with the same qualified name already exists, in which case that one is returned
+            r = self._insert_entity_if_absent(c, id, EntityType.Project, definition.qualified_name, definition.to_attr().to_json())
             if r:
                 if len(r) > 1:
                     assert False, "Data inconsistency detected, %d entities have same qualified_name %s" % (
@@ -298,16 +552,6 @@ class DbRegistry(Registry):
                                      definition.qualified_name)
                 # Just return the existing project id
                 return _to_uuid(r[0]["entity_id"])
-            id = uuid4()
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.insert(self.entities_table).values(entity_id= str(id), entity_type=str(EntityType.Project), qualified_name=definition.qualified_name, attributes =definition.to_attr().to_json())
-                r = self.connection.execute(query)
-            else:
-                c.execute(f"insert into entities (entity_id, entity_type, qualified_name, attributes) values (%s, %s, %s, %s)",
-                        (str(id),
-                        str(EntityType.Project),
-                        definition.qualified_name,
-                        definition.to_attr().to_json()))
             return id
 
     def create_project_datasource(self, project_id: UUID, definition: SourceDef) -> UUID:
@@ -315,14 +559,9 @@ class DbRegistry(Registry):
         definition.qualified_name = f"{project.qualified_name}__{definition.name}"
         # Here we start a transaction, any following step failed, everything rolls back
         with self.conn.transaction() as c:
-            # First we try to find existing entity with the same qualified name
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.select(self.entities_table.c.entity_id, self.entities_table.c.entity_type, self.entities_table.c.attributes).where((self.entities_table.c.qualified_name == definition.qualified_name)) 
-                r = self._fetch_helper(query)
-            else:
-                c.execute(f'''select entity_id, entity_type, attributes from entities where qualified_name = %s''',
-                        definition.qualified_name)
-                r = c.fetchall()
+            id = uuid4()
+            # Insert the new entity unless one with the same qualified name already exists, in which case that one is returned
+            r = self._insert_entity_if_absent(c, id, EntityType.Source, definition.qualified_name, definition.to_attr().to_json())
             if r:
                 if len(r) > 1:
                     # There are multiple entities with same qualified name， that means we already have errors in the db
@@ -333,7 +572,7 @@ class DbRegistry(Registry):
                     raise ConflictError("Entity %s already exists" %
                                      definition.qualified_name)
                 attr: SourceAttributes = _to_type(
-                    json.loads(r[0]["attributes"]), SourceAttributes)
+                    orjson.loads(r[0]["attributes"]), SourceAttributes)
                 if attr.name == definition.name \
                         and attr.type == definition.type \
                         and attr.options == definition.options \
@@ -345,18 +584,10 @@ class DbRegistry(Registry):
                     return _to_uuid(r[0]["entity_id"])
                 raise ConflictError("Entity %s already exists" %
                                  definition.qualified_name)
-            id = uuid4()
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.insert(self.entities_table).values(entity_id= str(id), entity_type=str(EntityType.Source), qualified_name=definition.qualified_name, attributes =definition.to_attr().to_json())
-                self.connection.execute(query)
-            else:
-                c.execute(f"insert into entities (entity_id, entity_type, qualified_name, attributes) values (%s, %s, %s, %s)",
-                        (str(id),
-                        str(EntityType.Source),
-                        definition.qualified_name,
-                        definition.to_attr().to_json()))
-            self._create_edge(c, project_id, id, RelationshipType.Contains)
-            self._create_edge(c, id, project_id, RelationshipType.BelongsTo)
+            self._create_edges(c, [
+                (project_id, id, RelationshipType.Contains),
+                (id, project_id, RelationshipType.BelongsTo),
+            ])
             return id
 
     def create_project_anchor(self, project_id: UUID, definition: AnchorDef) -> UUID:
@@ -364,14 +595,21 @@ class DbRegistry(Registry):
         definition.qualified_name = f"{project.qualified_name}__{definition.name}"
         # Here we start a transaction, any following step failed, everything rolls back
         with self.conn.transaction() as c:
-            # First we try to find existing entity with the same qualified name
             if os.environ.get("FEATHR_SANDBOX"):
-                query = db.select(self.entities_table.c.entity_id, self.entities_table.c.entity_type, self.entities_table.c.attributes).where((self.entities_table.c.qualified_name == definition.qualified_name)) 
+                query = db.select(self.entities_table.c.entity_id, self.entities_table.c.qualified_name).where((self.entities_table.c.entity_id == str(definition.source_id)) & (self.entities_table.c.entity_type == str(EntityType.Source))) 
                 r = self._fetch_helper(query)
             else:
-                c.execute(f'''select entity_id, entity_type, attributes from entities where qualified_name = %s''',
-                        definition.qualified_name)
+                c.execute("select entity_id, qualified_name from entities where entity_id = %s and entity_type = %s", (str(
+                    definition.source_id), str(EntityType.Source)))
                 r = c.fetchall()
+            if not r:
+                raise ValueError("Source %s does not exist" %
+                                 definition.source_id)
+            ref = EntityRef(r[0]["entity_id"],
+                            EntityType.Source, r[0]["qualified_name"])
+            id = uuid4()
+            # Insert the new entity unless one with the same qualified name already exists, in which case that one is returned
+            r = self._insert_entity_if_absent(c, id, EntityType.Anchor, definition.qualified_name, definition.to_attr(ref).to_json())
             if r:
                 if len(r) > 1:
                     # There are multiple entities with same qualified name， that means we already have errors in the db
@@ -382,43 +620,21 @@ class DbRegistry(Registry):
                     raise ConflictError("Entity %s already exists" %
                                      definition.qualified_name)
                 attr: AnchorAttributes = _to_type(
-                    json.loads(r[0]["attributes"]), AnchorAttributes)
+                    orjson.loads(r[0]["attributes"]), AnchorAttributes)
                 if attr.name == definition.name:
                     # Creating exactly same entity
                     # Just return the existing id
                     return _to_uuid(r[0]["entity_id"])
                 raise ConflictError("Entity %s already exists" %
                                  definition.qualified_name)
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.select(self.entities_table.c.entity_id, self.entities_table.c.qualified_name).where((self.entities_table.c.entity_id == str(definition.source_id)) & (self.entities_table.c.entity_type == str(EntityType.Source))) 
-                r = self._fetch_helper(query)
-            else:
-                c.execute("select entity_id, qualified_name from entities where entity_id = %s and entity_type = %s", (str(
-                    definition.source_id), str(EntityType.Source)))
-                r = c.fetchall()
-            if not r:
-                raise ValueError("Source %s does not exist" %
-                                 definition.source_id)
-            ref = EntityRef(r[0]["entity_id"],
-                            EntityType.Source, r[0]["qualified_name"])
-            id = uuid4()
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.insert(self.entities_table).values(entity_id= str(id), entity_type=str(EntityType.Anchor), qualified_name=definition.qualified_name, attributes =definition.to_attr(ref).to_json())
-                self.connection.execute(query)
-            else:
-                c.execute(f"insert into entities (entity_id, entity_type, qualified_name, attributes) values (%s, %s, %s, %s)",
-                        (str(id),
-                        str(EntityType.Anchor),
-                        definition.qualified_name,
-                        definition.to_attr(ref).to_json()))
-            # Add "Contains/BelongsTo" relations between anchor and project
-            self._create_edge(c, project_id, id, RelationshipType.Contains)
-            self._create_edge(c, id, project_id, RelationshipType.BelongsTo)
-            # Add "Consumes/Produces" relations between anchor and datasource
-            self._create_edge(c, id, definition.source_id,
-                              RelationshipType.Consumes)
-            self._create_edge(c, definition.source_id, id,
-                              RelationshipType.Produces)
+            self._create_edges(c, [
+                # Add "Contains/BelongsTo" relations between anchor and project
+                (project_id, id, RelationshipType.Contains),
+                (id, project_id, RelationshipType.BelongsTo),
+                # Add "Consumes/Produces" relations between anchor and datasource
+                (id, definition.source_id, RelationshipType.Consumes),
+                (definition.source_id, id, RelationshipType.Produces),
+            ])
             return id
 
     def create_project_anchor_feature(self, project_id: UUID, anchor_id: UUID, definition: AnchorFeatureDef) -> UUID:
@@ -426,14 +642,9 @@ class DbRegistry(Registry):
         definition.qualified_name = f"{anchor.qualified_name}__{definition.name}"
         # Here we start a transaction, any following step failed, everything rolls back
         with self.conn.transaction() as c:
-            # First we try to find existing entity with the same qualified name
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.select(self.entities_table.c.entity_id, self.entities_table.c.entity_type, self.entities_table.c.attributes).where((self.entities_table.c.qualified_name == definition.qualified_name)) 
-                r = self._fetch_helper(query)
-            else:
-                c.execute(f'''select entity_id, entity_type, attributes from entities where qualified_name = %s''',
-                        definition.qualified_name)
-                r = c.fetchall()
+            id = uuid4()
+            # Insert the new entity unless one with the same qualified name already exists, in which case that one is returned
+            r = self._insert_entity_if_absent(c, id, EntityType.AnchorFeature, definition.qualified_name, definition.to_attr().to_json())
             if r:
                 if len(r) > 1:
                     # There are multiple entities with same qualified name， that means we already have errors in the db
@@ -444,7 +655,7 @@ class DbRegistry(Registry):
                     raise ConflictError("Entity %s already exists" %
                                      definition.qualified_name)
                 attr: AnchorFeatureAttributes = _to_type(
-                    json.loads(r[0]["attributes"]), AnchorFeatureAttributes)
+                    orjson.loads(r[0]["attributes"]), AnchorFeatureAttributes)
                 if attr.name == definition.name \
                         and attr.type == definition.feature_type \
                         and attr.transformation == definition.transformation \
@@ -456,25 +667,17 @@ class DbRegistry(Registry):
                 raise ConflictError("Entity %s already exists" %
                                  definition.qualified_name)
             source_id = anchor.attributes.source.id
-            id = uuid4()
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.insert(self.entities_table).values(entity_id= str(id), entity_type=str(EntityType.AnchorFeature), qualified_name=definition.qualified_name, attributes =definition.to_attr().to_json())
-                r = self.connection.execute(query)
-            else:
-                c.execute(f"insert into entities (entity_id, entity_type, qualified_name, attributes) values (%s, %s, %s, %s)",
-                        (str(id),
-                        str(EntityType.AnchorFeature),
-                        definition.qualified_name,
-                        definition.to_attr().to_json()))
-            # Add "Contains/BelongsTo" relations between anchor feature and project
-            self._create_edge(c, project_id, id, RelationshipType.Contains)
-            self._create_edge(c, id, project_id, RelationshipType.BelongsTo)
-            # Add "Contains/BelongsTo" relations between anchor feature and anchor
-            self._create_edge(c, anchor_id, id, RelationshipType.Contains)
-            self._create_edge(c, id, anchor_id, RelationshipType.BelongsTo)
-            # Add "Consumes/Produces" relations between anchor feature and datasource used by anchor
-            self._create_edge(c, id, source_id, RelationshipType.Consumes)
-            self._create_edge(c, source_id, id, RelationshipType.Produces)
+            self._create_edges(c, [
+                # Add "Contains/BelongsTo" relations between anchor feature and project
+                (project_id, id, RelationshipType.Contains),
+                (id, project_id, RelationshipType.BelongsTo),
+                # Add "Contains/BelongsTo" relations between anchor feature and anchor
+                (anchor_id, id, RelationshipType.Contains),
+                (id, anchor_id, RelationshipType.BelongsTo),
+                # Add "Consumes/Produces" relations between anchor feature and datasource used by anchor
+                (id, source_id, RelationshipType.Consumes),
+                (source_id, id, RelationshipType.Produces),
+            ])
             return id
 
     def create_project_derived_feature(self, project_id: UUID, definition: DerivedFeatureDef) -> UUID:
@@ -482,14 +685,24 @@ class DbRegistry(Registry):
         definition.qualified_name = f"{project.qualified_name}__{definition.name}"
         # Here we start a transaction, any following step failed, everything rolls back
         with self.conn.transaction() as c:
-            # First we try to find existing entity with the same qualified name
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.select(self.entities_table.c.entity_id, self.entities_table.c.entity_type, self.entities_table.c.attributes).where((self.entities_table.c.qualified_name == definition.qualified_name)) 
-                r = self._fetch_helper(query)
-            else:
-                c.execute(f'''select entity_id, entity_type, attributes from entities where qualified_name = %s''',
-                        definition.qualified_name)
-                r = c.fetchall()
+            # Fill `input_anchor_features` and `input_derived_features`, from `definition` we have ids only, we still need qualified names.
+            # Inputs are usually shared by many derived features, so the entity row cache answers most of these lookups
+            # Both lists are looked up together, each is then checked against its own ids and type
+            inputs = self._get_entities(list(definition.input_anchor_features) + list(definition.input_derived_features))
+            anchor_ids = set([str(id) for id in definition.input_anchor_features])
+            derived_ids = set([str(id) for id in definition.input_derived_features])
+            r1 = [e for e in inputs if str(e.id) in anchor_ids and e.entity_type == EntityType.AnchorFeature]
+            if len(r1) != len(definition.input_anchor_features):
+                # TODO: More detailed error
+                raise(ValueError("Missing input anchor features"))
+            r2 = [e for e in inputs if str(e.id) in derived_ids and e.entity_type == EntityType.DerivedFeature]
+            if len(r2) != len(definition.input_derived_features):
+                # TODO: More detailed error
+                raise(ValueError("Missing input derived features"))
+            refs = [e.get_ref() for e in r1+r2]
+            id = uuid4()
+            # Insert the new entity unless one with the same qualified name already exists, in which case that one is returned
+            r = self._insert_entity_if_absent(c, id, EntityType.DerivedFeature, definition.qualified_name, definition.to_attr(refs).to_json())
             if r:
                 if len(r) > 1:
                     # There are multiple entities with same qualified name， that means we already have errors in the db
@@ -500,7 +713,7 @@ class DbRegistry(Registry):
                     raise ConflictError("Entity %s already exists" %
                                      definition.qualified_name)
                 attr: DerivedFeatureAttributes = _to_type(
-                    json.loads(r[0]["attributes"]), DerivedFeatureAttributes)
+                    orjson.loads(r[0]["attributes"]), DerivedFeatureAttributes)
                 if attr.name == definition.name \
                         and attr.type == definition.feature_type \
                         and attr.transformation == definition.transformation \
@@ -511,87 +724,90 @@ class DbRegistry(Registry):
                 # The existing entity has different definition, that's a conflict
                 raise ConflictError("Entity %s already exists" %
                                  definition.qualified_name)
-            r1 = []
-            # Fill `input_anchor_features`, from `definition` we have ids only, we still need qualified names
-            if definition.input_anchor_features:
-                if os.environ.get("FEATHR_SANDBOX"):
-                    query = self.sql_session.query(Entities.entity_id, Entities.entity_type, Entities.qualified_name).filter(Entities.entity_id.in_(tuple([str(id) for id in definition.input_anchor_features])), Entities.entity_type == str(EntityType.AnchorFeature))
-                    r1 = self._fetch_helper(query)
-                else:
-                    c.execute(
-                        fr'''select entity_id, entity_type, qualified_name from entities where entity_id in %s and entity_type = %s ''', (tuple([str(id) for id in definition.input_anchor_features]), str(EntityType.AnchorFeature)))
-                    r1 = c.fetchall()
-                if len(r1) != len(definition.input_anchor_features):
-                    # TODO: More detailed error
-                    raise(ValueError("Missing input anchor features"))
-            # Fill `input_derived_features`, from `definition` we have ids only, we still need qualified names
-            r2 = []
-            if definition.input_derived_features:
-                if os.environ.get("FEATHR_SANDBOX"):
-                    query = self.sql_session.query(Entities.entity_id, Entities.entity_type, Entities.qualified_name).filter(Entities.entity_id.in_(tuple([str(id) for id in definition.input_derived_features])), Entities.entity_type == str(EntityType.DerivedFeature))
-                    r2 = self._fetch_helper(query)
-                else:
-                    c.execute(
-                        fr'''select entity_id, entity_type, qualified_name from entities where entity_id in %s and entity_type = %s ''', (tuple([str(id) for id in definition.input_derived_features]), str(EntityType.DerivedFeature)))
-                    r2 = c.fetchall()
-                if len(r2) != len(definition.input_derived_features):
-                    # TODO: More detailed error
-                    raise(ValueError("Missing input derived features"))
-            refs = list([EntityRef(r["entity_id"], r["entity_type"], r["qualified_name"]) for r in r1+r2])
-            id = uuid4()
-            if os.environ.get("FEATHR_SANDBOX"):
-                query = db.insert(self.entities_table).values(entity_id= str(id), entity_type=str(EntityType.DerivedFeature), qualified_name=definition.qualified_name, attributes =definition.to_attr(refs).to_json())
-                self.connection.execute(query)
-            else:
-                c.execute(f"insert into entities (entity_id, entity_type, qualified_name, attributes) values (%s, %s, %s, %s)",
-                        (str(id),
-                        str(EntityType.DerivedFeature),
-                        definition.qualified_name,
-                        definition.to_attr(refs).to_json()))
             # Add "Contains/BelongsTo" relations between derived feature and project
-            self._create_edge(c, project_id, id, RelationshipType.Contains)
-            self._create_edge(c, id, project_id, RelationshipType.BelongsTo)
-            for r in r1+r2:
+            edges = [
+                (project_id, id, RelationshipType.Contains),
+                (id, project_id, RelationshipType.BelongsTo),
+            ]
+            for e in r1+r2:
                 # Add "Consumes/Produces" relations between derived feature and all its upstream
-                input_feature_id = r["entity_id"]
-                self._create_edge(c, id, input_feature_id,
-                                  RelationshipType.Consumes)
-                self._create_edge(c, input_feature_id, id,
-                                  RelationshipType.Produces)
+                input_feature_id = e.id
+                edges.append((id, input_feature_id, RelationshipType.Consumes))
+                edges.append((input_feature_id, id, RelationshipType.Produces))
+            self._create_edges(c, edges)
             return id
 
-    def _create_edge(self, cursor, from_id: UUID, to_id: UUID, type: RelationshipType):
+    def _insert_entity_if_absent(self, cursor, id: UUID, entity_type: EntityType, qualified_name: str, attributes: str) -> List[Dict]:
+        """
+        Insert a new entity unless there is already one with the same qualified name.
+        Returns the existing entities with that name, an empty list means the new entity has been inserted.
+        """
+        if os.environ.get("FEATHR_SANDBOX"):
+            r = self._fetch_helper(self.statements["get_entity_by_name"], {"qualified_name": qualified_name})
+            if not r:
+                with self.engine.begin() as conn:
+                    conn.execute(self.statements["insert_entity"], {
+                        "entity_id": str(id),
+                        "entity_type": str(entity_type),
+                        "qualified_name": qualified_name,
+                        "attributes": attributes,
+                    })
+            return r
+        # One round trip for both the check and the insert, the range lock keeps a concurrent
+        # transaction from inserting the same name between them.
+        # `nocount` keeps the insert's row count from coming back ahead of the select's rows, it lasts for
+        # the whole session, so it's turned off again before the pooled connection is used for anything else
+        cursor.execute(r'''
+            set nocount on;
+            insert into entities (entity_id, entity_type, qualified_name, attributes)
+            select %(entity_id)s, %(entity_type)s, %(qualified_name)s, %(attributes)s
+            where not exists (select 1 from entities with (updlock, holdlock) where qualified_name = %(qualified_name)s);
+            select entity_id, entity_type, attributes from entities where qualified_name = %(qualified_name)s and entity_id <> %(entity_id)s;
+            set nocount off;
+        ''', {
+            "entity_id": str(id),
+            "entity_type": str(entity_type),
+            "qualified_name": qualified_name,
+            "attributes": attributes,
+        })
+        return cursor.fetchall()
+
+    def _create_edges(self, cursor, edges: List[Tuple[UUID, UUID, RelationshipType]]):
         """
-        Create an edge with specified type between 2 entities, skip if the same connection already exists
+        Create edges given as `(from_id, to_id, type)` in one statement, skip the ones whose connection already exists
         """
+        # Repeated connections would pass the `not exists` check together, keep the first one only
+        edges = list(dict.fromkeys([(str(from_id), str(to_id), type.name) for from_id, to_id, type in edges]))
+        edge_ids = _batch_uuids(len(edges))
         if os.environ.get("FEATHR_SANDBOX"):
             # TODO: might not be a safe solution since it's not transactional 
-            query = db.insert(self.edges_table).values(edge_id= str(uuid4()), from_id=str(from_id), to_id=str(to_id), conn_type =type.name)
-            self.connection.execute(query)
-        else:
-            sql = r'''
-            IF NOT EXISTS (SELECT 1 FROM edges WHERE from_id=%(from_id)s and to_id=%(to_id)s and conn_type=%(type)s)
-                    BEGIN
-                        INSERT INTO edges
-                        (edge_id, from_id, to_id, conn_type)
-                        values
-                        (%(edge_id)s, %(from_id)s, %(to_id)s, %(type)s)
-                    END'''
-            cursor.execute(sql, {
-                "edge_id": str(uuid4()),
-                "from_id": str(from_id),
-                "to_id": str(to_id),
-                "type": type.name
-            })
+            with self.engine.begin() as conn:
+                conn.execute(self.statements["insert_edge"], [{"edge_id": edge_id, "from_id": from_id, "to_id": to_id, "conn_type": type}
+                                                              for edge_id, (from_id, to_id, type) in zip(edge_ids, edges)])
+            return
+        # SQL Server allows 2100 parameters per statement, 4 are used per edge.
+        # The range lock keeps a concurrent transaction from inserting the same edge between the check and the insert
+        for i in range(0, len(edges), EDGE_INSERT_BATCH_SIZE):
+            batch = edges[i:i + EDGE_INSERT_BATCH_SIZE]
+            batch_ids = edge_ids[i:i + EDGE_INSERT_BATCH_SIZE]
+            sql = fr'''
+            insert into edges (edge_id, from_id, to_id, conn_type)
+            select v.edge_id, v.from_id, v.to_id, v.conn_type
+            from (values {", ".join(["(%s, %s, %s, %s)"] * len(batch))}) as v (edge_id, from_id, to_id, conn_type)
+            where not exists (select 1 from edges with (updlock, holdlock) where edges.from_id = v.from_id and edges.to_id = v.to_id and edges.conn_type = v.conn_type)'''
+            params = []
+            for edge_id, (from_id, to_id, type) in zip(batch_ids, batch):
+                params.extend([edge_id, from_id, to_id, type])
+            cursor.execute(sql, tuple(params))
     
     def _delete_all_entity_edges(self, cursor, entity_id: UUID):
         """
         Deletes all edges associated with an entity
         """
         if os.environ.get("FEATHR_SANDBOX"):
-            row_to_delete = self.sql_session.query(Edges).filter((Edges.from_id == str(entity_id)) | Edges.to_id == str(entity_id))
-            row_to_delete.delete()
-            self.sql_session.commit()
+            row_to_delete = self.sql_session.query(Edges).filter(or_(Edges.from_id == str(entity_id), Edges.to_id == str(entity_id)))
+            # Bulk delete, no ORM objects are loaded so there's nothing in the session to synchronize
+            row_to_delete.delete(synchronize_session=False)
         else:
             sql = fr'''DELETE FROM edges WHERE from_id = %s OR to_id = %s'''
             cursor.execute(sql, (str(entity_id), str(entity_id)))
@@ -602,134 +818,188 @@ class DbRegistry(Registry):
         """
         if os.environ.get("FEATHR_SANDBOX"):
             row_to_delete = self.sql_session.query(Entities).filter((Entities.entity_id == str(entity_id)))
-            # self.sql_session.delete(row_to_delete)
-            row_to_delete.delete()
-            self.sql_session.commit()
+            row_to_delete.delete(synchronize_session=False)
         else:
             sql = fr'''DELETE FROM entities WHERE entity_id = %s'''
             cursor.execute(sql, str(entity_id))
 
-    def _fill_entity(self, e: Entity) -> Entity:
+    def _fill_entities(self, entities: List[Entity]) -> List[Entity]:
         """
         Entities in the DB contains only attributes belong to itself, but the returned
-        data model contains connections/contents, so we need to fill this gap
+        data model contains connections/contents, so we need to fill this gap.
+        All entities are filled with one query for their edges and one for the entities they connect to.
         """
-        if e.entity_type == EntityType.Project:
-            edges = self.get_neighbors(e.id, RelationshipType.Contains)
-            ids = list([e.to_id for e in edges])
-            children = self._get_entities(ids)
-            e.attributes.children = children
-            return e
-        if e.entity_type == EntityType.Anchor:
-            conn = self.get_neighbors(e.id, RelationshipType.Contains)
-            feature_ids = [e.to_id for e in conn]
-            features = self._get_entities(feature_ids)
-            e.attributes.features = features
-            source_id = self.get_neighbors(
-                e.id, RelationshipType.Consumes)[0].to_id
-            source = self.get_entity(source_id)
-            e.attributes.source = source
-            return e
-        if e.entity_type == EntityType.DerivedFeature:
-            conn = self.get_neighbors(e.id, RelationshipType.Consumes)
-            feature_ids = [e.to_id for e in conn]
-            features = self._get_entities(feature_ids)
-            e.attributes.input_features = features
-            return e
-        return e
+        ids = [e.id for e in entities if e.entity_type in (EntityType.Project, EntityType.Anchor, EntityType.DerivedFeature)]
+        neighbors = {}
+        for edge in self._get_out_edges(ids, [RelationshipType.Contains, RelationshipType.Consumes]):
+            neighbors.setdefault((edge.from_id, edge.conn_type), []).append(edge.to_id)
+        connected = dict([(c.id, c) for c in self._get_entities(list(set([to_id for to_ids in neighbors.values() for to_id in to_ids])))])
+
+        def connected_to(e: Entity, conn_type: RelationshipType) -> List[Entity]:
+            return [connected[id] for id in neighbors.get((e.id, conn_type), []) if id in connected]
+
+        for e in entities:
+            if e.entity_type == EntityType.Project:
+                e.attributes.children = connected_to(e, RelationshipType.Contains)
+            elif e.entity_type == EntityType.Anchor:
+                e.attributes.features = connected_to(e, RelationshipType.Contains)
+                e.attributes.source = connected_to(e, RelationshipType.Consumes)[0]
+            elif e.entity_type == EntityType.DerivedFeature:
+                e.attributes.input_features = connected_to(e, RelationshipType.Consumes)
+        return entities
 
     def _get_edges(self, ids: List[UUID], types: List[RelationshipType] = []) -> List[Edge]:
+        """
+        All edges between any two of `ids`, optionally only the ones with any of `types`.
+        Only `from_id` is matched in SQL, which seeks on the edge index, `to_id` is checked here
+        rather than sending the same id list a second time.
+        """
         if not ids:
             return []
+        id_strs = tuple(set([str(id) for id in ids]))
         if os.environ.get("FEATHR_SANDBOX"):
             if len(types) > 0:
-                query = self.sql_session.query(Edges.edge_id,Edges.from_id, Edges.to_id, Edges.conn_type).filter((Edges.from_id.in_(tuple([str(id) for id in ids]))) & (Edges.to_id.in_(tuple([str(id) for id in ids]))) & (Edges.conn_type.in_(tuple([t.name for t in types]))) )
+                rows = self._fetch_helper(self.statements["get_edges_from_by_type"], {"ids": list(id_strs), "types": [t.name for t in types]})
             else:
-                query = self.sql_session.query(Edges.edge_id,Edges.from_id, Edges.to_id, Edges.conn_type).filter((Edges.from_id.in_(tuple([str(id) for id in ids]))) & (Edges.to_id.in_(tuple([str(id) for id in ids]))))
-            
-            rows = self._fetch_helper(query)
+                rows = self._fetch_helper(self.statements["get_edges_from"], {"ids": list(id_strs)})
         else:
             sql = fr"""select edge_id, from_id, to_id, conn_type from edges
-            where from_id in %(ids)s
-            and to_id in %(ids)s"""
+            where from_id in %(ids)s"""
             if len(types) > 0:
-                sql = fr"""select edge_id, from_id, to_id, conn_type from edges
-                where conn_type in %(types)s
-                and from_id in %(ids)s
-                and to_id in %(ids)s"""
-            
+                sql += " and conn_type in %(types)s"
             rows = self.conn.query(sql, {
-                "ids": tuple([str(id) for id in ids]),
+                "ids": id_strs,
                 "types": tuple([t.name for t in types]),
             })
-        return list([_to_type(row, Edge) for row in rows])
+        id_set = set(id_strs)
+        return [Edge(**row) for row in rows if str(row["to_id"]) in id_set]
+
+    def _get_out_edges(self, ids: List[UUID], conn_types: List[RelationshipType]) -> List[Edge]:
+        """
+        All edges with any of `conn_types` that start from any of `ids`
+        """
+        if not ids:
+            return []
+        if os.environ.get("FEATHR_SANDBOX"):
+            rows = self._fetch_helper(self.statements["get_edges_from_by_type"], {"ids": [str(id) for id in ids], "types": [t.name for t in conn_types]})
+        else:
+            sql = fr"""select edge_id, from_id, to_id, conn_type from edges where conn_type in %s and from_id in %s"""
+            rows = self.conn.query(sql, (tuple([t.name for t in conn_types]), tuple([str(id) for id in ids])))
+        return [Edge(**row) for row in rows]
+
+    def _get_contained(self, id: UUID) -> Tuple[List[Edge], List[Entity]]:
+        """
+        The "Contains" edges starting from `id` along with the entities they point to, in one query
+        """
+        if os.environ.get("FEATHR_SANDBOX"):
+            query = db.select(Edges.edge_id, Edges.from_id, Edges.to_id, Edges.conn_type, Entities.entity_id, Entities.qualified_name, Entities.entity_type, Entities.attributes).join(Entities, Entities.entity_id == Edges.to_id).where(Edges.from_id == str(id), Edges.conn_type == RelationshipType.Contains.name)
+            rows = self._fetch_helper(query)
+        else:
+            rows = self.conn.query(fr'''select edge_id, from_id, to_id, conn_type, entity_id, qualified_name, entity_type, attributes
+                from edges
+                inner join entities on entity_id = edges.to_id
+                where from_id = %s and conn_type = %s
+            ''', (str(id), RelationshipType.Contains.name))
+        edges = [Edge(row["edge_id"], row["from_id"], row["to_id"], row["conn_type"]) for row in rows]
+        return edges, [_to_entity(row) for row in rows]
 
     def _get_entity(self, id_or_name: Union[str, UUID]) -> Entity:
+        id = str(self.get_entity_id(id_or_name))
+        with self._entity_id_lock:
+            row = self._entity_row_cache.get(id)
+        if row is not None:
+            return _to_entity(row)
         if os.environ.get("FEATHR_SANDBOX"):
-            query = db.select(self.entities_table.c.entity_id, self.entities_table.c.qualified_name, self.entities_table.c.entity_type, self.entities_table.c.attributes).where((self.entities_table.c.entity_id == str(self.get_entity_id(id_or_name)))) 
-            row = self._fetch_helper(query)
+            rows = self._fetch_helper(self.statements["get_entity"], {"entity_id": id})
         else:
-            row = self.conn.query(fr'''
+            rows = self.conn.query(fr'''
             select entity_id, qualified_name, entity_type, attributes
             from entities
             where entity_id = %s
-        ''', self.get_entity_id(id_or_name))
-        if not row:
+        ''', id)
+        if not rows:
             raise KeyError(f"Entity {id_or_name} not found")
-        row=row[0]
-        row["attributes"] = json.loads(row["attributes"])
-        return _to_type(row, Entity)
+        return _to_entity(next(iter(self._cache_entity_rows(rows).values())))
 
     def _get_entities(self, ids: List[UUID]) -> List[Entity]:
-        if not ids:
-            return []
-        if os.environ.get("FEATHR_SANDBOX"):
-            query = self.sql_session.query(Entities.entity_id, Entities.qualified_name,Entities.entity_type, Entities.attributes).filter(Entities.entity_id.in_(tuple([str(id) for id in ids]), ))
-            rows = self._fetch_helper(query)
-        else:
-            rows = self.conn.query(fr'''select entity_id, qualified_name, entity_type, attributes
-                from entities
-                where entity_id in %s
-            ''', (tuple([str(id) for id in ids]), ))
-        ret = []
-        for row in rows:
-            row["attributes"] = json.loads(row["attributes"])
-            ret.append(Entity(**row))
-        return ret
+        """
+        Entities with the given ids in the same order, ids that don't exist are skipped
+        """
+        ids = list(dict.fromkeys([str(id) for id in ids]))
+        with self._entity_id_lock:
+            rows = dict([(id, self._entity_row_cache[id]) for id in ids if id in self._entity_row_cache])
+        missing = [id for id in ids if id not in rows]
+        if missing:
+            if os.environ.get("FEATHR_SANDBOX"):
+                fetched = self._fetch_helper(self.statements["get_entities"], {"ids": missing})
+            else:
+                fetched = self.conn.query(fr'''select entity_id, qualified_name, entity_type, attributes
+                    from entities
+                    where entity_id in %s
+                ''', (tuple(missing), ))
+            rows.update(self._cache_entity_rows(fetched))
+        return [_to_entity(rows[id]) for id in ids if id in rows]
 
-    def _bfs(self, id: UUID, conn_type: RelationshipType) -> Tuple[List[Entity], List[Edge]]:
+    def _cache_entity_rows(self, rows: List[Dict]) -> Dict[str, Dict]:
+        """
+        Parse the attributes of fetched rows once and cache the rows, returns them by entity id
+        """
+        parsed = dict([(str(row["entity_id"]), {
+            "entity_id": row["entity_id"],
+            "qualified_name": row["qualified_name"],
+            "entity_type": row["entity_type"],
+            "attributes": orjson.loads(row["attributes"]),
+        }) for row in rows])
+        with self._entity_id_lock:
+            self._entity_row_cache.update(parsed)
+        return parsed
+
+    def _bfs(self, id: UUID, conn_type: RelationshipType, max_depth: int = MAX_TRAVERSAL_DEPTH) -> Tuple[List[Entity], List[Edge]]:
         """
         Breadth first traversal
-        Starts from `id`, follow edges with `conn_type` only.
-
-        WARN: There is no depth limit.
-        """
-        connections = []
-        to_ids = [{
-            "to_id": id,
-        }]
-        # BFS over SQL
-        while len(to_ids) != 0:
-            to_ids = self._bfs_step(to_ids, conn_type)
-            connections.extend(to_ids)
-        ids = set([id])
+        Starts from `id`, follow edges with `conn_type` only, at most `max_depth` edges away.
+        """
+        connections = self._get_reachable_edges(id, conn_type, max_depth)
+        ids = set([str(id)])
         for r in connections:
-            ids.add(r["from_id"])
-            ids.add(r["to_id"])
+            ids.add(str(r["from_id"]))
+            ids.add(str(r["to_id"]))
         entities = self.get_entities(ids)
-        edges = list([Edge(**c) for c in connections])
+        edges = [Edge(**c) for c in connections]
         return (entities, edges)
 
-    def _bfs_step(self, ids: List[UUID], conn_type: RelationshipType) -> Set[Dict]:
+    def _get_downstream_ids(self, id: UUID, conn_type: RelationshipType, max_depth: int = MAX_TRAVERSAL_DEPTH) -> Set[str]:
         """
-        One step of the BFS process
-        Returns all edges that connect to node ids the next step
+        Ids of all entities reachable from `id` by following edges with `conn_type`
         """
-        ids = list([id["to_id"] for id in ids])
+        return set([str(r["to_id"]) for r in self._get_reachable_edges(id, conn_type, max_depth)])
+
+    def _get_reachable_edges(self, id: UUID, conn_type: RelationshipType, max_depth: int = MAX_TRAVERSAL_DEPTH) -> List[Dict]:
+        """
+        All edges with `conn_type` reachable from `id` within `max_depth` steps, the whole subgraph is walked by a recursive CTE
+        on the server side so the traversal takes one round trip instead of one per level.
+        Each row carries the ids on its path, an edge leading back into its own path is returned but not followed,
+        so a cycle ends the walk right there instead of going around until `max_depth`
+        """
+        params = {
+            "id": str(id),
+            "type": conn_type.name,
+            "max_depth": int(max_depth),
+        }
         if os.environ.get("FEATHR_SANDBOX"):
-            query = self.sql_session.query(Edges.edge_id,Edges.from_id, Edges.to_id, Edges.conn_type).filter(Edges.conn_type == conn_type.name, Edges.from_id.in_(tuple([str(id) for id in ids])))
-            r = self._fetch_helper(query)
-            return r
-        else:
-            sql = fr"""select edge_id, from_id, to_id, conn_type from edges where conn_type = %s and from_id in %s"""
-            return self.conn.query(sql, (conn_type.name, tuple([str(id) for id in ids])))
+            return self._fetch_helper(self.statements["get_reachable_edges"], params)
+        # SQL Server only allows `union all` in recursive CTEs, a diamond in the graph yields its edges more than once
+        sql = fr"""
+            with reach (edge_id, from_id, to_id, conn_type, depth, path, cycle) as (
+                select edge_id, from_id, to_id, conn_type, 1, cast('/' + from_id + '/' + to_id + '/' as varchar(max)),
+                    case when from_id = to_id then 1 else 0 end
+                from edges where from_id = %(id)s and conn_type = %(type)s
+                union all
+                select edges.edge_id, edges.from_id, edges.to_id, edges.conn_type, reach.depth + 1,
+                    cast(reach.path + edges.to_id + '/' as varchar(max)),
+                    case when charindex('/' + edges.to_id + '/', reach.path) > 0 then 1 else 0 end
+                from edges inner join reach on edges.from_id = reach.to_id
+                where edges.conn_type = %(type)s and reach.depth < %(max_depth)s and reach.cycle = 0
+            )
+            select distinct edge_id, from_id, to_id, conn_type from reach"""
+        return self.conn.query(sql, params)
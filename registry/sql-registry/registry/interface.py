@@ -1,5 +1,5 @@
 from abc import ABC, abstractclassmethod, abstractmethod
-from typing import Union, List, Dict
+from typing import Iterator, Union, List, Dict
 from uuid import UUID
 from registry.database import DbConnection
 
@@ -35,6 +35,42 @@ class Registry(ABC):
         """
         pass
 
+    @abstractmethod
+    def get_project_datasources(self, project: Union[str, UUID]) -> List[Entity]:
+        """
+        Get all data sources of a project
+        """
+        pass
+
+    @abstractmethod
+    def get_project_datasource(self, project: Union[str, UUID], datasource: Union[str, UUID]) -> Optional[Entity]:
+        """
+        Get one data source of a project by its id, returns None if the project doesn't have it
+        """
+        pass
+
+    @abstractmethod
+    def get_project_features(self,
+                             project: Union[str, UUID],
+                             keyword: Optional[str] = None,
+                             start: Optional[int] = None,
+                             size: Optional[int] = None) -> List[Entity]:
+        """
+        Get anchor and derived features of a project, optionally filtered by keyword and paged
+        """
+        pass
+
+    @abstractmethod
+    def iter_project_features(self,
+                              project: Union[str, UUID],
+                              keyword: Optional[str] = None,
+                              start: Optional[int] = None,
+                              size: Optional[int] = None) -> Iterator[Entity]:
+        """
+        Same as `get_project_features`, but yields the features one by one
+        """
+        pass
+
     @abstractmethod
     def get_entity_id(self, id_or_name: Union[str, UUID]) -> UUID:
         """
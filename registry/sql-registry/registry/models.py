@@ -2,10 +2,21 @@ from abc import ABC, abstractmethod
 from enum import Enum
 from typing import Any, Dict, List, Optional, Union
 from uuid import UUID
+from functools import lru_cache
 import json
+import orjson
 import re
 
 
+_CAMEL_BOUNDARY = re.compile(r'(?<!^)(?=[A-Z])')
+
+
+@lru_cache(maxsize=4096)
+def _str_to_snake(s: str) -> str:
+    # Request bodies reuse the same handful of keys, so most conversions are cache hits
+    return _CAMEL_BOUNDARY.sub('_', s).lower()
+
+
 def to_snake(d, level: int = 0):
     """
     Convert `string`, `list[string]`, or all keys in a `dict` into snake case
@@ -15,8 +26,7 @@ def to_snake(d, level: int = 0):
     if level >= 10:
         raise ValueError("Too many nested levels")
     if isinstance(d, str):
-        d = d[:100]
-        return re.sub(r'(?<!^)(?=[A-Z])', '_', d).lower()
+        return _str_to_snake(d[:100])
     if isinstance(d, list):
         d = d[:100]
         return [to_snake(i, level + 1) if isinstance(i, (dict, list)) else i for i in d]
@@ -34,7 +44,7 @@ def _to_type(value, type):
     if isinstance(value, type):
         return value
     if isinstance(value, list):
-        return list([_to_type(v, type) for v in value])
+        return [_to_type(v, type) for v in value]
     if isinstance(value, dict):
         if hasattr(type, "new"):
             try:
@@ -92,22 +102,21 @@ class EntityType(Enum):
 
     @staticmethod
     def new(v):
-        return {
-            "feathr_workspace_v1": EntityType.Project,
-            "feathr_source_v1": EntityType.Source,
-            "feathr_anchor_v1": EntityType.Anchor,
-            "feathr_anchor_feature_v1": EntityType.AnchorFeature,
-            "feathr_derived_feature_v1": EntityType.DerivedFeature,
-        }[v]
+        return _ENTITY_TYPES_BY_NAME[v]
 
     def __str__(self):
-        return {
-            EntityType.Project: "feathr_workspace_v1",
-            EntityType.Source: "feathr_source_v1",
-            EntityType.Anchor: "feathr_anchor_v1",
-            EntityType.AnchorFeature: "feathr_anchor_feature_v1",
-            EntityType.DerivedFeature: "feathr_derived_feature_v1",
-        }[self]
+        return _ENTITY_TYPE_NAMES[self]
+
+
+# Built once, `str(EntityType)` runs for every serialized entity and reference
+_ENTITY_TYPE_NAMES = {
+    EntityType.Project: "feathr_workspace_v1",
+    EntityType.Source: "feathr_source_v1",
+    EntityType.Anchor: "feathr_anchor_v1",
+    EntityType.AnchorFeature: "feathr_anchor_feature_v1",
+    EntityType.DerivedFeature: "feathr_derived_feature_v1",
+}
+_ENTITY_TYPES_BY_NAME = dict([(v, k) for k, v in _ENTITY_TYPE_NAMES.items()])
 
 
 class RelationshipType(Enum):
@@ -126,6 +135,9 @@ class ToDict(ABC):
         pass
 
     def to_json(self, indent=None) -> str:
+        if indent is None:
+            # Entity attributes are stored this way on every write, orjson is much faster and its output more compact
+            return orjson.dumps(self.to_dict()).decode()
         return json.dumps(self.to_dict(), indent=indent)
 
 
@@ -339,6 +351,16 @@ class Entity(ToDict):
                          self.attributes.entity_type,
                          self.qualified_name)
 
+    def to_ref_dict(self) -> Dict:
+        """
+        Same as `get_ref().to_dict()`, without building the intermediate `EntityRef`
+        """
+        return {
+            "guid": str(self.id),
+            "typeName": str(self.attributes.entity_type),
+            "uniqueAttributes": {"qualifiedName": self.qualified_name},
+        }
+
     def to_dict(self) -> Dict:
         return {
             "guid": str(self.id),
@@ -401,13 +423,23 @@ class ProjectAttributes(Attributes):
             e for e in self.children if e.entity_type == EntityType.DerivedFeature]
 
     def to_dict(self) -> Dict:
+        # Group the children in one pass instead of filtering the whole list once per type
+        refs = {
+            EntityType.Source: [],
+            EntityType.Anchor: [],
+            EntityType.AnchorFeature: [],
+            EntityType.DerivedFeature: [],
+        }
+        for e in self.children:
+            if e.entity_type in refs:
+                refs[e.entity_type].append(e.to_ref_dict())
         return {
             "qualifiedName": self.name,
             "name": self.name,
-            "sources": list([e.get_ref().to_dict() for e in self.sources]),
-            "anchors": list([e.get_ref().to_dict() for e in self.anchors]),
-            "anchorFeatures": list([e.get_ref().to_dict() for e in self.anchor_features]),
-            "derivedFeatures": list([e.get_ref().to_dict() for e in self.derived_features]),
+            "sources": refs[EntityType.Source],
+            "anchors": refs[EntityType.Anchor],
+            "anchorFeatures": refs[EntityType.AnchorFeature],
+            "derivedFeatures": refs[EntityType.DerivedFeature],
             "tags": self.tags,
         }
 
@@ -510,7 +542,7 @@ class AnchorAttributes(Attributes):
         ret = {
             "qualifiedName": self.qualified_name,
             "name": self.name,
-            "features": list([e.get_ref().to_dict() for e in self.features]),
+            "features": [e.get_ref().to_dict() for e in self.features],
             "tags": self.tags,
         }
         if self.source is not None:
@@ -543,7 +575,7 @@ class AnchorFeatureAttributes(Attributes):
             "name": self.name,
             "type": self.type.to_dict(),
             "transformation": self.transformation.to_dict(),
-            "key": list([k.to_dict() for k in self.key]),
+            "key": [k.to_dict() for k in self.key],
             "tags": self.tags,
         }
 
@@ -615,7 +647,7 @@ class DerivedFeatureAttributes(Attributes):
             "name": self.name,
             "type": self.type.to_dict(),
             "transformation": self.transformation.to_dict(),
-            "key": list([k.to_dict() for k in self.key]),
+            "key": [k.to_dict() for k in self.key],
             "inputAnchorFeatures": [e.to_dict() for e in self.input_anchor_features],
             "inputDerivedFeatures": [e.to_dict() for e in self.input_derived_features],
             "tags": self.tags,
@@ -656,8 +688,8 @@ class EntitiesAndRelations(ToDict):
 
     def to_dict(self) -> Dict:
         return {
-            "guidEntityMap": dict([(str(id), self.entities[id].to_dict()) for id in self.entities]),
-            "relations": list([e.to_dict() for e in self.edges]),
+            "guidEntityMap": {str(id): e.to_dict() for id, e in self.entities.items()},
+            "relations": [e.to_dict() for e in self.edges],
         }
 
 
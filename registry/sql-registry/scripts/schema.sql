@@ -12,4 +12,18 @@ create table edges
     from_id   varchar(50) not null,
     to_id     varchar(50) not null,
     conn_type varchar(20) not null,
-)
\ No newline at end of file
+)
+
+-- Keyword search filters by type and sorts by name, `like '%keyword%'` can't seek on any index,
+-- but scanning this narrow index is much cheaper than scanning the table with its `attributes` column
+create index ix_entities_type_name on entities (entity_type, qualified_name)
+
+-- Name lookups run on every request and every write, covering `entity_type` saves the key lookup for conflict checks,
+-- qualified names identify entities so the index also rejects duplicates
+create unique index ix_entities_qualified_name on entities (qualified_name) include (entity_id, entity_type)
+
+-- Neighbor lookups and lineage walks filter edges by one endpoint and the type,
+-- the included columns let them be answered from the index alone.
+-- There is at most one edge of each type between two entities, the first index also enforces that
+create unique index ux_edges_from_conn_to on edges (from_id, conn_type, to_id) include (edge_id)
+create index ix_edges_to_conn on edges (to_id, conn_type) include (from_id, edge_id)
@@ -1,5 +1,4 @@
 import registry
-from registry.db_registry import quote
 from registry.models import AnchorDef, AnchorFeatureDef, DerivedFeatureDef, ExpressionTransformation, FeatureType, ProjectDef, SourceDef, TensorCategory, Transformation, TypedKey, ValueType, VectorType
 
 r = registry.DbRegistry()
@@ -7,11 +6,11 @@ r = registry.DbRegistry()
 
 def cleanup():
     with r.conn.transaction() as c:
-        ids = quote([project1_id, source1_id, anchor1_id, af1_id, df1_id])
+        ids = tuple([str(id) for id in [project1_id, source1_id, anchor1_id, af1_id, df1_id]])
         c.execute(
-            f"delete from edges where from_id in ({ids}) or to_id in ({ids})")
+            "delete from edges where from_id in %(ids)s or to_id in %(ids)s", {"ids": ids})
         c.execute(
-            f"delete from entities where entity_id in ({ids})")
+            "delete from entities where entity_id in %(ids)s", {"ids": ids})
 
 
 project1_id = r.create_project(ProjectDef("unit_test_project_1"))
@@ -0,0 +1,126 @@
+import os
+import sys
+import tempfile
+# The sandbox provider is picked when `registry.database` is imported, set it up before importing the registry
+os.environ["FEATHR_SANDBOX"] = "1"
+os.environ.setdefault("CONNECTION_STR", "")
+os.environ["FEATHR_SANDBOX_REGISTRY_URL"] = f"sqlite:///{tempfile.mkdtemp()}/registry.sqlite"
+os.environ["API_BASE"] = "api/v1"
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import unittest
+
+from fastapi.testclient import TestClient
+
+from registry.cache import ResponseCache
+from registry.db_registry import DbRegistry
+from registry.models import AnchorDef, AnchorFeatureDef, ExpressionTransformation, FeatureType, ProjectDef, RelationshipType, SourceDef, TensorCategory, TypedKey, ValueType, VectorType
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_repeated_reads_are_served_from_cache(self):
+        cache = ResponseCache(ttl=60)
+        calls = []
+        def fetch():
+            calls.append(1)
+            return len(calls)
+        assert cache.get_or_compute("key", fetch) == 1
+        assert cache.get_or_compute("key", fetch) == 1
+        assert len(calls) == 1
+        # Other keys are computed separately
+        assert cache.get_or_compute("other", fetch) == 2
+
+    def test_clear_drops_cached_responses(self):
+        cache = ResponseCache(ttl=60)
+        assert cache.get_or_compute("key", lambda: "old") == "old"
+        cache.clear()
+        assert cache.get_or_compute("key", lambda: "new") == "new"
+
+    def test_result_computed_across_a_write_is_not_stored(self):
+        cache = ResponseCache(ttl=60)
+        def fetch_then_write():
+            # A write clears the cache while this read is still running
+            cache.clear()
+            return "stale"
+        assert cache.get_or_compute("key", fetch_then_write) == "stale"
+        assert cache.get_or_compute("key", lambda: "fresh") == "fresh"
+
+    def test_zero_ttl_disables_caching(self):
+        cache = ResponseCache(ttl=0)
+        assert cache.get_or_compute("key", lambda: 1) == 1
+        assert cache.get_or_compute("key", lambda: 2) == 2
+
+
+class SandboxLineageTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = DbRegistry()
+
+    def tearDown(self):
+        self.registry.close()
+
+    def create_anchor_features(self, project_name, count):
+        project_id = self.registry.create_project(ProjectDef(project_name))
+        source_id = self.registry.create_project_datasource(project_id, SourceDef(
+            qualified_name=f"{project_name}__source1", name="source1", path="hdfs://somewhere", type="hdfs"))
+        anchor_id = self.registry.create_project_anchor(project_id, AnchorDef(
+            qualified_name=f"{project_name}__anchor1", name="anchor1", source_id=source_id))
+        ft = FeatureType(type=VectorType.TENSOR, tensor_category=TensorCategory.DENSE,
+                         dimension_type=[], val_type=ValueType.INT)
+        k = TypedKey(key_column="c1", key_column_type=ValueType.INT)
+        return [self.registry.create_project_anchor_feature(project_id, anchor_id, AnchorFeatureDef(
+            qualified_name=f"{project_name}__anchor1__af{i}", name=f"af{i}", feature_type=ft,
+            transformation=ExpressionTransformation(f"af{i}"), key=[k])) for i in range(count)]
+
+    def test_lineage_stops_at_cycles(self):
+        a, b, c = self.create_anchor_features("unit_test_cycle", 3)
+        # a -> b -> c -> a, plus an edge from c back to itself
+        self.registry._create_edges(None, [(a, b, RelationshipType.Consumes),
+                                           (b, c, RelationshipType.Consumes),
+                                           (c, a, RelationshipType.Consumes),
+                                           (c, c, RelationshipType.Consumes)])
+        edges = [(e["from_id"], e["to_id"]) for e in self.registry._get_reachable_edges(a, RelationshipType.Consumes)]
+        # Every edge is returned exactly once, including the ones closing the cycle.
+        # Anchor features also consume their anchor, so there are more edges than the cycle
+        assert len(edges) == len(set(edges))
+        cycle = set([(str(a), str(b)), (str(b), str(c)), (str(c), str(a)), (str(c), str(c))])
+        assert cycle <= set(edges)
+        first_step = self.registry._get_reachable_edges(a, RelationshipType.Consumes, max_depth=1)
+        assert (str(a), str(b)) in [(e["from_id"], e["to_id"]) for e in first_step]
+        assert (str(b), str(c)) not in [(e["from_id"], e["to_id"]) for e in first_step]
+        lineage = self.registry.get_lineage(a).to_dict()
+        assert set([str(a), str(b), str(c)]) <= set(lineage["guidEntityMap"])
+        assert set([str(a), str(b), str(c)]) <= self.registry._get_downstream_ids(b, RelationshipType.Consumes)
+
+
+class SandboxApiTest(unittest.TestCase):
+    def setUp(self):
+        import main
+        self.client = TestClient(main.app)
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+    def test_etag_and_write_invalidation(self):
+        r = self.client.get("/api/v1/projects")
+        assert r.status_code == 200
+        etag = r.headers["etag"]
+        # Same content, the client's copy is still good
+        r = self.client.get("/api/v1/projects", headers={"If-None-Match": etag})
+        assert r.status_code == 304
+        assert r.headers["etag"] == etag
+        assert r.content == b""
+        r = self.client.get("/api/v1/projects", headers={"If-None-Match": f'W/"other", {etag}'})
+        assert r.status_code == 304
+        r = self.client.get("/api/v1/projects", headers={"If-None-Match": '"other"'})
+        assert r.status_code == 200
+
+        # A write shows up right away instead of after the cache TTL
+        assert self.client.post("/api/v1/projects", json={"name": "unit_test_etag"}).status_code == 200
+        r = self.client.get("/api/v1/projects", headers={"If-None-Match": etag})
+        assert r.status_code == 200
+        assert r.headers["etag"] != etag
+        assert "unit_test_etag" in r.json()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,7 +4,7 @@ from datetime import datetime
 #sys.path.append(os.path.join(os.path.dirname(sys.path[0]),'purview-registry'))
 import unittest, pytest
 
-from registry.db_registry import DbRegistry, quote, ConflictError
+from registry.db_registry import DbRegistry, ConflictError
 from registry.models import AnchorDef, AnchorFeatureDef, DerivedFeatureDef, ExpressionTransformation, WindowAggregationTransformation, UdfTransformation, FeatureType, ProjectDef, SourceDef, TensorCategory, Transformation, TypedKey, ValueType, VectorType, EntityType
 
 class SqlRegistryTest(unittest.TestCase):
@@ -16,11 +16,11 @@ class SqlRegistryTest(unittest.TestCase):
     
     def cleanup(self, ids):
         with self.registry.conn.transaction() as c:
-            ids = quote(ids)
+            ids = tuple([str(id) for id in ids])
             c.execute(
-                f"delete from edges where from_id in ({ids}) or to_id in ({ids})")
+                "delete from edges where from_id in %(ids)s or to_id in %(ids)s", {"ids": ids})
             c.execute(
-                f"delete from entities where entity_id in ({ids})")
+                "delete from entities where entity_id in %(ids)s", {"ids": ids})
             
     def create_and_get_project(self, project_name):
         project_id = self.registry.create_project(ProjectDef(project_name))